@@ -1,33 +1,32 @@
 import sys
 sys.path.append('.')
-from utils.sql import start_sqlsession
-from utils.datamodel import Article
-from utils.misc import md5sum
-from utils.cleaning import wrong_encoding
+from utils.sql import start_sqlsession, get_sidecar_path, bulk_insert
+from utils.datamodel import Article, IngestedFile, CleaningWatermark
+from utils.ingest import prepare_articles, prepare_files_parallel, iter_feather_batches, read_feather, prefetch, sample_batches
+from utils.ingest import is_unchanged, record_file, COMPRESSED_SUFFIXES
+from utils.dedup import HashIndex
+from utils.profiling import StageTimer
 import pandas as pd
 from pathlib import Path
+from datetime import datetime
 from argparse import ArgumentParser
-import re
-# run pandas apply in parallel:
-import swifter
-swifter.set_defaults(allow_dask_on_strings=True)
-# ftfy: fix text for you (solves encoding issues)
-import ftfy
-from typing import Union, Any
-
-# safe wrapper
-def fix_text(text: Any) -> Union[str, None]:
-    try:
-        return ftfy.fix_text(text)
-    except:
-        return None
+
+
+def drop_existing(df: pd.DataFrame, article_md5: HashIndex) -> pd.DataFrame:
+    """ drop duplicates; make sure article not in db already """
+    filt = article_md5.contains(df.article_md5)
+    return df[~filt].reset_index(drop=True)
 
 
 if __name__ == '__main__':
     arg_parser = ArgumentParser(description="Load all feather files in 'raw_data' to the SQL Databse")
-    arg_parser.add_argument('--debug', action='store_true', help='Debug flag: only load a random sample')
+    arg_parser.add_argument('--debug', action='store_true', help='Debug flag: only load a random sample (100 articles per file)')
     arg_parser.add_argument('--clean', action='store_true', help='Clean the database before loading (delete all articles)')
     arg_parser.add_argument("--wikipedia", action='store_true', help='Only load wikipedia data')
+    arg_parser.add_argument('--force', action='store_true', help='Load all files, also files that were loaded before and did not change')
+    arg_parser.add_argument('--stream', action='store_true', help='Memory-map feather files and load them in batches (constant memory)')
+    arg_parser.add_argument('--batch_size', type=int, default=50000, help='Number of rows per batch in streaming mode (default: 50,000 rows)')
+    arg_parser.add_argument('--workers', type=int, default=1, help='Number of worker processes that prepare feather files in parallel (default: 1). Implies --stream')
 
     input_args = arg_parser.parse_args()
     
@@ -36,8 +35,18 @@ if __name__ == '__main__':
     if input_args.clean:
         print('Cleaning database...')
         session.query(Article).delete()
+        session.query(IngestedFile).delete()
+        # article ids can be reused: previous cleaning runs do not cover the new articles
+        session.query(CleaningWatermark).delete()
         session.commit()
 
+    # measure time, throughput and memory of every stage
+    timer = StageTimer()
+    files_report = []
+
+    # persistent index of all article hashes in the database
+    article_md5 = HashIndex.open(get_sidecar_path(engine, 'article_md5'), session, Article.article_md5)
+
     p = Path.cwd() / "raw_data"
 
     if input_args.wikipedia:
@@ -45,52 +54,93 @@ if __name__ == '__main__':
     else:
         glob_pattern = "*.feather"
 
-    for feather in p.rglob(glob_pattern):
-        # get exisiting Articles by md5 id
-        article_md5 = session.query(Article.article_md5).all()
-        article_md5 = [a[0] for a in article_md5]
-        print('Loading feather file', feather)
-        df = pd.read_feather(feather)
-        if input_args.debug:
-            df = df.sample(100).reset_index(drop=True)
-
-        print('Calculating md5 sum for URL column')
-        df['article_md5'] = df.url.swifter.apply(md5sum)
-        df.drop_duplicates(subset="article_md5", inplace=True, ignore_index=True)
-
-        # some texts might have the wrong encoding
-        text_cols = {"headline", "description", "pretitle", "lead_paragraph", "body"}
-        text_cols = set(df.columns.tolist()).intersection(text_cols)
-
-        encoding_issues = False
-        # if any column has an encoding issue, we assume that the entire dataset is corrupted
-        for indicator in wrong_encoding:
-            for col in text_cols:
-                try:
-                    _issues = sum(df[col].str.contains(indicator))
-                    if _issues > 0:
-                        print('Detected encoding issue in column', col)
-                        encoding_issues = True
-                        break
-                except:
+    # compressed files are read directly; unless there is a decompressed copy
+    feather_files = set(p.rglob(glob_pattern))
+    for suffix in COMPRESSED_SUFFIXES:
+        feather_files.update(f for f in p.rglob(glob_pattern + suffix) if f.with_suffix('') not in feather_files)
+    feather_files = sorted(feather_files)
+
+    # skip files that were loaded completely before (debug runs only load samples)
+    if not input_args.force and not input_args.debug:
+        with engine.begin() as connection:
+            skipped = [f for f in feather_files if is_unchanged(connection, f, p)]
+        for feather in skipped:
+            print('Skipping unchanged file', feather)
+            files_report.append(dict(file=feather.name, skipped=True))
+        feather_files = [f for f in feather_files if f not in skipped]
+
+    if input_args.workers > 1:
+        print(f'Preparing {len(feather_files)} feather files with {input_args.workers} workers')
+        # workers prepare the articles, this process is the only one writing to the database
+        batches = prepare_files_parallel(feather_files, input_args.workers,
+                                         batch_size=input_args.batch_size,
+                                         debug=input_args.debug)
+        rows_read = {f: 0 for f in feather_files}
+        rows_added = {f: 0 for f in feather_files}
+        with engine.begin() as connection:
+            for feather, df, n_rows, timings in batches:
+                timer.merge(timings)
+                if df is None:
+                    # file completed
+                    if not input_args.debug:
+                        record_file(connection, feather, p, rows_read[feather], rows_added[feather])
+                    files_report.append(dict(file=feather.name, rows_read=rows_read[feather], rows_added=rows_added[feather]))
                     continue
+                print('Writing batch of', feather)
+                with timer.stage(feather.name, 'dedup', rows=len(df)):
+                    df = drop_existing(df, article_md5)
+                with timer.stage(feather.name, 'sql write', rows=len(df)):
+                    bulk_insert(connection, Article.__table__, df)
+                article_md5.add(df.article_md5)
+                rows_read[feather] += n_rows
+                rows_added[feather] += len(df)
+        article_md5.flush()
+    else:
+        for feather in feather_files:
+            print('Loading feather file', feather)
+
+            if input_args.stream:
+                # read the next batch in the background while the current one is written
+                reader = prefetch(iter_feather_batches(feather, batch_size=input_args.batch_size))
+            else:
+                reader = iter([read_feather(feather)])
+            batches = timer.iterate(reader, feather.name, 'read')
+            if input_args.debug:
+                # sample from the whole file
+                batches = [sample_batches(batches)]
+
+            rows_read = 0
+            rows_added = 0
+            try:
+                for df in batches:
+                    rows_read += len(df)
+                    df = prepare_articles(df, feather.name, timer=timer)
+                    with timer.stage(feather.name, 'dedup', rows=len(df)):
+                        df = drop_existing(df, article_md5)
+
+                    # save to SQL db
+                    with timer.stage(feather.name, 'sql write', rows=len(df)), engine.begin() as connection:
+                        bulk_insert(connection, Article.__table__, df)
+                    # later batches / files must not load these articles again
+                    article_md5.add(df.article_md5)
+                    rows_added += len(df)
+            finally:
+                # stop the background reader (e.g., after an error)
+                if input_args.stream:
+                    reader.close()
+
+            article_md5.flush()
+            timer.add(feather.name, 'read', bytes=feather.stat().st_size)
+            if not input_args.debug:
+                with engine.begin() as connection:
+                    record_file(connection, feather, p, rows_read, rows_added)
+            files_report.append(dict(file=feather.name, rows_read=rows_read, rows_added=rows_added))
+            print(f'Added {rows_added} of {rows_read} articles')
+
+    # merge newly added hashes into the sorted index
+    article_md5.save()
 
-        if encoding_issues:
-            print('fixing encoding')
-            for col in text_cols:
-                df[col] = df[col].swifter.apply(fix_text)
-
-        if 'diepresse' in feather.name:
-            # there is currently a parsing bug that caused some 
-            # sentences not to be separated properly
-            # we can fix that with a crude regex
-            wrong_sentences = re.compile(r"(\b[A-ZÄÖÜa-zäöü]{3,}?!?)([A-Z])")
-            df['body'] = df['body'].swifter.apply(lambda x: wrong_sentences.sub(r"\1. \2", x))
-            
-            
-        # drop duplicates; make sure article not in db already
-        filt = df.article_md5.isin(article_md5)
-        df = df[~filt].reset_index(drop=True)
-
-        # save to SQL db
-        df.to_sql(Article.__tablename__, session.bind, if_exists="append", index=False)
+    print(timer.summary())
+    report_file = get_sidecar_path(engine, f"ingest_report_{datetime.now():%Y%m%d_%H%M%S}.json")
+    timer.write_json(report_file, settings=vars(input_args), files=files_report)
+    print('Saved ingest report to', report_file)
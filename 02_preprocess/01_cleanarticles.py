@@ -1,78 +1,242 @@
 import sys
 sys.path.append('.')
-from utils.sql import start_sqlsession
-from utils.datamodel import Article, ProcessedParagraph
-from utils.misc import md5sum
-from utils.cleaning import clean_text
+from utils.sql import start_sqlsession, upsert_counts, get_sidecar_path, SQLArticleReader
+from utils.articlestore import start_articlestore
+from utils.datamodel import ProcessedParagraph, CleaningSettings, TokenFrequency, CleaningWatermark
+from utils.misc import md5sum_batch
+from utils.cleaning import CleaningPlan, CLEANING_DEFAULTS, get_cleaning_plan, clean_texts, number_words_cache_info
+from utils.cleaningcache import CleaningCache
 from argparse import ArgumentParser
 from tqdm import tqdm
-from sqlalchemy.orm import sessionmaker
-import sqlalchemy
 from multiprocessing import Pool
+from functools import partial
+from collections import Counter
+from itertools import chain, groupby
+from threading import Semaphore
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+import time
+import json
+import random
+from pathlib import Path
 
 # start sql
 session, engine = start_sqlsession()
+# optional: read articles from parquet files instead
+article_store = start_articlestore()
 
-def add_if_not_duplicated(text: str) -> None:
-    """ Take a text (string) then calc md5 sum 
-        check if it is already in the SQL database,
-        if not then add new text
-        if already exists, increment count by 1
+# columns required for cleaning an article
+ARTICLE_COLUMNS = ['pretitle', 'headline', 'lead_paragraph', 'body']
+
+def write_paragraphs(paragraphs: List[Tuple[str, str, str]]) -> int:
+    """ Take a list of (settings fingerprint, text, md5 sum) tuples,
+        count duplicates within the batch and write all of them in one transaction:
+        new texts are inserted, for existing texts the count is increased.
+        Returns the number of unique texts in the batch.
+    """
+    records = {}
+    for fingerprint, text, text_md5 in paragraphs:
+        key = (fingerprint, text_md5)
+        if key in records:
+            records[key]['count'] += 1
+        else:
+            records[key] = {'settings': fingerprint, 'md5': text_md5, 'text': text, 'n_tokens': len(text.split()), 'count': 1}
+    with engine.begin() as con:
+        upsert_counts(con, ProcessedParagraph.__table__, list(records.values()), keys=['settings', 'md5'])
+    return len(records)
+
+def write_token_frequencies(token_counts: Dict[str, Counter]) -> int:
+    """ Write token frequencies (per settings fingerprint) in one transaction:
+        new tokens are inserted, for existing tokens the count is increased.
+        Returns the number of tokens written.
+    """
+    records = [{'settings': fingerprint, 'token': token, 'count': count}
+               for fingerprint, counter in token_counts.items()
+               for token, count in counter.items()]
+    with engine.begin() as con:
+        upsert_counts(con, TokenFrequency.__table__, records, keys=['settings', 'token'])
+    return len(records)
+
+def split_article(pretitle: str, headline: str, lead_paragraph: str, body: str) -> List[str]:
+    """ All paragraphs of an article (headline, lead paragraph, body) """
+    title = pretitle or " "
+    title += " "
+    title += headline or ""
+    paragraphs = [title, lead_paragraph]
+    if body is not None:
+        paragraphs += body.split('\n\n')
+    return paragraphs
+
+
+# cleaning cache of the worker process (opened once by the pool initializer)
+_cache: Optional[CleaningCache] = None
+
+
+def clean_paragraphs(paragraphs: List[str], plan: CleaningPlan, hexdigests: Optional[List[str]],
+                     cache: Optional[CleaningCache]) -> Tuple[List[str], List[Tuple[str, str]]]:
+    """ Clean paragraphs (with the cache if any), returns the cleaned paragraphs and the new cache items """
+    if cache is None:
+        return clean_texts(paragraphs, plan), []
+    return cache.clean_texts(paragraphs, plan, hexdigests=hexdigests)
+
+
+def clean_articles(paragraphs: List[str], article_ids: List[int], plan: CleaningPlan,
+                   hexdigests: Optional[List[str]],
+                   cache: Optional[CleaningCache]) -> Tuple[List[str], List[Tuple[str, str]]]:
+    """ Clean the paragraphs of a chunk at once; if that fails, clean them article by article
+        and skip the articles that cannot be cleaned
     """
-    if text == "":
-        return None
-    local_session = sessionmaker(bind=engine)()
-    text_md5 = md5sum(text)
-    duplicated_text = local_session.query(ProcessedParagraph).filter(ProcessedParagraph.md5 == text_md5).first()
-    if duplicated_text:
-        duplicated_text.count += 1
-    else:
-        n_tokens = len(text.split())
-        new_text = ProcessedParagraph(md5=text_md5, text=text, n_tokens=n_tokens)
-        local_session.add(new_text)
-    local_session.commit()
-    local_session.close()
-
-def get_article(article_id: int) -> Article:
-    local_session = sessionmaker(bind=engine)()
-    article = local_session.query(Article).filter(Article.id == article_id).first()
-    local_session.close()
-    return article
-
-def process_article(article_id: int, **kwargs) -> None:
     try:
-        article = get_article(article_id)
-        headline = article.pretitle or " "
-        headline += " "
-        headline += article.headline or ""
-        headline = clean_text(headline, **kwargs)
-        add_if_not_duplicated(headline)
-        lead_paragraph = clean_text(article.lead_paragraph, **kwargs)
-        add_if_not_duplicated(lead_paragraph)
+        return clean_paragraphs(paragraphs, plan, hexdigests, cache)
+    except Exception:
+        pass
+    cleaned, new_items = [], []
+    # paragraphs of an article are next to each other
+    for article_id, indices in groupby(range(len(paragraphs)), key=article_ids.__getitem__):
+        indices = list(indices)
+        try:
+            article_cleaned, article_items = clean_paragraphs(
+                [paragraphs[i] for i in indices], plan,
+                [hexdigests[i] for i in indices] if hexdigests is not None else None, cache)
+        except Exception as e:
+            print(f'couldnt process article {article_id}:', e)
+            continue
+        cleaned += article_cleaned
+        new_items += article_items
+    return cleaned, new_items
+
 
-        for paragraph in article.body.split('\n\n'):
-            paragraph = clean_text(paragraph, **kwargs)
-            add_if_not_duplicated(paragraph)
+def clean_chunk(articles: List[tuple], plans: List[CleaningPlan],
+                watermarks: Optional[Dict[str, int]] = None) -> Tuple[List[Tuple[str, str, str]], int, int, Dict[str, List[Tuple[str, str]]], Dict[str, Counter], Counter]:
+    """ Worker function: clean a chunk of articles
+        (tuples of id, pretitle, headline, lead_paragraph, body)
+        with every cleaning plan (variant), using the worker's cleaning cache (if any).
+        The articles are split into paragraphs (and hashed) only once for all variants.
+        Articles that cannot be split or cleaned are skipped.
+        `watermarks`: per fingerprint, articles up to this id were already processed in a previous run
+        Returns all non-empty paragraphs as (settings fingerprint, text, md5 sum),
+        the number of articles in the chunk, the highest article id in the chunk,
+        the newly cleaned paragraphs for the cleaning cache (per fingerprint)
+        the token counts of the chunk (per fingerprint; every occurrence of a paragraph is counted)
+        and statistics of the chunk (hits of the cleaning cache, hits and misses of the worker's number cache)
+    """
+    number_cache = number_words_cache_info()
+    cache_hits = _cache.hits if _cache else 0
+    paragraphs = []
+    article_ids = []
+    for article_id, *article in articles:
+        try:
+            article_paragraphs = split_article(*article)
+        except Exception as e:
+            print(f'couldnt process article {article_id}:', e)
+            continue
+        paragraphs += article_paragraphs
+        article_ids += [article_id] * len(article_paragraphs)
+    cache = _cache
+    raw_md5 = md5sum_batch(paragraphs) if cache else None
+    results = []
+    new_items = {}
+    token_counts = {}
+    for plan in plans:
+        plan_paragraphs, plan_md5, plan_ids = paragraphs, raw_md5, article_ids
+        watermark = (watermarks or {}).get(plan.fingerprint, 0)
+        if watermark and article_ids and min(article_ids) <= watermark:
+            # some articles of the chunk were already processed with these settings
+            keep = [i for i, article_id in enumerate(article_ids) if article_id > watermark]
+            plan_paragraphs = [paragraphs[i] for i in keep]
+            plan_md5 = [raw_md5[i] for i in keep] if raw_md5 is not None else None
+            plan_ids = [article_ids[i] for i in keep]
+        cleaned, items = clean_articles(plan_paragraphs, plan_ids, plan, plan_md5, cache)
+        if cache is not None:
+            new_items[plan.fingerprint] = items
+        cleaned = [paragraph for paragraph in cleaned if paragraph != ""]
+        token_counts[plan.fingerprint] = Counter(chain.from_iterable(paragraph.split() for paragraph in cleaned))
+        results += [(plan.fingerprint, text, text_md5) for text, text_md5 in zip(cleaned, md5sum_batch(cleaned))]
+    max_id = max((article[0] for article in articles), default=0)
+    stats = Counter({f'number_{key}': value - number_cache[key]
+                     for key, value in number_words_cache_info().items() if key in ('hits', 'misses')})
+    stats['cache_hits'] = (_cache.hits if _cache else 0) - cache_hits
+    return results, len(articles), max_id, new_items, token_counts, stats
+
+
+def variant_settings(settings: dict, variant: str) -> dict:
+    """ Settings of a variant: comma separated settings that are switched on,
+        or switched off with the prefix "no_".
+        E.g., "lowercase" or "remove_numbers,no_replace_numbers"
+    """
+    settings = dict(settings)
+    for name in variant.split(','):
+        name = name.strip()
+        value = not name.startswith('no_')
+        name = name[3:] if name.startswith('no_') else name
+        if name not in CLEANING_DEFAULTS:
+            raise ValueError(f'Unknown cleaning setting in variant "{variant}": {name}')
+        settings[name] = value
+    return settings
+
+
+def watermark_scope(before: str = None, after: str = None) -> str:
+    """ Articles processed in a run depend on the date filters: watermarks are kept per filter """
+    scope = []
+    if after:
+        scope.append(f'after={after}')
+    if before:
+        scope.append(f'before={before}')
+    return ','.join(scope)
 
-    except Exception as e:
-        print('couldnt process', e)
+
+def iter_article_chunks(articles, chunk_size: int, before: str = None, after: str = None,
+                        since_id: int = None, debug: bool = False) -> Iterator[List[tuple]]:
+    """ Read articles in chunks (only the id and the columns required for cleaning)
+        from the parquet store or the SQL database.
+        `debug`: only a random sample of 1000 articles
+    """
+    ids = None
+    if debug:
+        # sample from all articles: read only the ids first
+        ids = [article_id for batch in articles.iter_batches([], before=before, after=after, batch_size=100000,
+                                                             since_id=since_id)
+               for article_id in batch.id.tolist()]
+        ids = sorted(random.sample(ids, min(1000, len(ids))))
+    for batch in articles.iter_batches(ARTICLE_COLUMNS, before=before, after=after,
+                                       batch_size=chunk_size, since_id=since_id, ids=ids):
+        yield list(batch[['id'] + ARTICLE_COLUMNS].itertuples(index=False, name=None))
+
+
+def throttle(iterable: Iterable, semaphore: Semaphore) -> Iterator:
+    """ Pool.imap reads its input as fast as it can;
+        only hand out a new chunk when a result was consumed
+    """
+    for item in iterable:
+        semaphore.acquire()
+        yield item
 
 
-def initializer():
+def initializer(cache_path: Optional[Path] = None):
     """ensure the parent proc's database connections are not touched
     in the new connection pool
-    see SQL Alchemy documentation: 
+    see SQL Alchemy documentation:
     https://docs.sqlalchemy.org/en/20/core/pooling.html
+    Opens the cleaning cache once per worker (not for every chunk)
     """
+    global _cache
     engine.dispose(close=False)
+    if cache_path is not None:
+        _cache = CleaningCache(cache_path)
+        _cache.connection  # connect now: runs the PRAGMAs once
 
 
 if __name__ == '__main__':
     arg_parser = ArgumentParser(description="Process Articles and clean text")
-    arg_parser.add_argument('--debug', action='store_true', help='Debug flag: only load a random sample')
+    arg_parser.add_argument('--debug', action='store_true', help='Debug flag: only clean a random sample of 1000 articles')
     arg_parser.add_argument('--threads', type=int, default=1, help='Number of parallel processes (default: 1)')
-    arg_parser.add_argument('--clean_database', action='store_true', help='Remove all previously processed articles')
+    arg_parser.add_argument('--chunk_size', type=int, default=500, help='Number of articles per chunk sent to a worker process (default: 500)')
+    arg_parser.add_argument('--write_batch_size', type=int, default=50000, help='Number of paragraphs written to the database at once (default: 50,000)')
+    arg_parser.add_argument('--no_cache', action='store_true', help='Do not use the cleaning cache (clean all paragraphs again)')
+    arg_parser.add_argument('--clean_database', action='store_true', help='Remove previously processed articles (of the selected settings and variants)')
+    arg_parser.add_argument('--all_articles', action='store_true',
+                            help='Process all articles, also those that were already processed with the same settings in a previous run')
 
+    arg_parser.add_argument('--lowercase', action='store_true', help='Lowercase text')
     arg_parser.add_argument('--remove_links', action='store_true', help='Remove hyperlinks')
     arg_parser.add_argument('--remove_emails', action='store_true', help='Remove emails')
     arg_parser.add_argument('--remove_emojis', action='store_true', help='Remove emojis')
@@ -83,73 +247,133 @@ if __name__ == '__main__':
     arg_parser.add_argument('--genderstar', action='store_true', help='Preserve genderstar (normalize with underscore)')
     arg_parser.add_argument('--before', type=str, default=None, help='Only consider articles on and before the given date (YYYY-MM-DD)')
     arg_parser.add_argument('--after', type=str, default=None, help='Only consider articles on and after the given date (YYYY-MM-DD)')
-    
+    arg_parser.add_argument('--variant', type=str, action='append', default=[],
+                            help='Additionally produce a variant of the settings in the same pass (can be repeated), '
+                                 'e.g., "--variant lowercase" or "--variant remove_numbers,no_replace_numbers"')
+
     input_args = arg_parser.parse_args()
 
+    n_threads = input_args.threads
+
+    settings = {"lowercase": input_args.lowercase,
+                "remove_links": input_args.remove_links,
+                "remove_emails": input_args.remove_emails,
+                "remove_emojis": input_args.remove_emojis,
+                "remove_punctuation": input_args.remove_punctuation,
+                "remove_numbers": input_args.remove_numbers,
+                "replace_numbers": input_args.replace_numbers,
+                "remove_quotations": input_args.remove_quotations,
+                "genderstar": input_args.genderstar}
+
+    # one cleaning plan per variant; paragraphs are tagged with the fingerprint of the settings
+    plans = [get_cleaning_plan(**settings)]
+    plans += [get_cleaning_plan(**variant_settings(settings, variant)) for variant in input_args.variant]
+    plans = list({plan.fingerprint: plan for plan in plans}.values())
+    for plan in plans:
+        print(f'Settings {plan.fingerprint}: {json.dumps(plan.settings)}')
+        session.merge(CleaningSettings(fingerprint=plan.fingerprint, settings=json.dumps(plan.settings)))
+    session.commit()
+
     if input_args.clean_database:
-        print('Removing all previously processed articles')
-        session.query(ProcessedParagraph).delete()
+        print('Removing previously processed articles')
+        fingerprints = [plan.fingerprint for plan in plans]
+        session.query(ProcessedParagraph).filter(ProcessedParagraph.settings.in_(fingerprints)).delete()
+        session.query(TokenFrequency).filter(TokenFrequency.settings.in_(fingerprints)).delete()
+        session.query(CleaningWatermark).filter(CleaningWatermark.settings.in_(fingerprints)).delete()
         session.commit()
 
-    
-    n_threads = input_args.threads
+    # only process articles that were added since the last run with the same settings and date filters
+    scope = watermark_scope(before=input_args.before, after=input_args.after)
+    watermarks = {plan.fingerprint: 0 for plan in plans}
+    if not (input_args.all_articles or input_args.debug):
+        for watermark in session.query(CleaningWatermark).filter(CleaningWatermark.settings.in_(watermarks.keys()),
+                                                                 CleaningWatermark.scope == scope):
+            watermarks[watermark.settings] = watermark.last_id
+    articles = article_store or SQLArticleReader(engine)
+    # articles were deleted and ids reused (e.g., after reloading): the watermarks are not valid anymore
+    current_max_id = articles.max_id()
+    for fingerprint, last_id in watermarks.items():
+        if last_id > current_max_id:
+            print(f'Watermark of settings {fingerprint} (id {last_id}) is above the highest article id ({current_max_id}), '
+                  f'processing all articles again')
+            watermarks[fingerprint] = 0
+    since_id = min(watermarks.values())
+    if since_id:
+        print(f'Only processing articles with id > {since_id} (already processed in previous runs)')
 
-    # get all article ids and reformat to clean list
-    q = session.query(Article.id)
+    print(f'Reading articles from {articles}')
     if input_args.before:
         print(f'Got input argument "before": {input_args.before}')
-        q = q.filter(Article.date_published <= input_args.before)
     if input_args.after:
         print(f'Got input argument "after": {input_args.after}')
-        q = q.filter(Article.date_published >= input_args.after)
-    article_ids = q.all()
-    article_ids = [a[0] for a in article_ids]
-    print(f"Got {len(article_ids)} articles to parse")
+    n_articles = articles.count(before=input_args.before, after=input_args.after, since_id=since_id)
+    print(f"Got {n_articles} articles to parse")
     if input_args.debug:
-        import random
-        article_ids = random.sample(article_ids, 1000)
+        n_articles = min(n_articles, 1000)
+    chunks = iter_article_chunks(articles, input_args.chunk_size, before=input_args.before,
+                                 after=input_args.after, since_id=since_id, debug=input_args.debug)
 
-    settings = {"remove_links": input_args.remove_links,
-                "remove_emails": input_args.remove_emails,
-                "remove_emojis": input_args.remove_emojis,
-                "remove_punctuation": input_args.remove_punctuation,
-                "remove_numbers": input_args.remove_numbers,
-                "replace_numbers": input_args.replace_numbers,
-                "remove_quotations": input_args.remove_quotations,
-                "genderstar": input_args.genderstar}
+    # cleaned paragraphs of previous runs (per combination of settings)
+    cache = None if input_args.no_cache else CleaningCache(get_sidecar_path(engine, 'cleaning_cache.sqlite'))
+    if cache:
+        print(f'Using cleaning cache {cache.path}')
+        cache.connection  # create the cache before the workers open it
 
     print('Start cleaning ...')
 
-    with Pool(n_threads, initializer=initializer) as pool:
-        for raw_id in tqdm(article_ids, desc="Processing", unit="articles"):
-            pool.apply(process_article, (raw_id, ), kwds=settings)
-
-    if 'postgresql' in engine.dialect.name:
-        print('Calculating token counts')
-        clear_table = r"""
-            DO $$ 
-            BEGIN
-                IF EXISTS (SELECT 1 FROM information_schema.tables WHERE table_name = 'token_counts') THEN
-                    -- If it exists, delete the table
-                    DROP TABLE token_counts;
-                END IF;
-            END $$;
-        """
-
-        count_tokens = """
-            CREATE TABLE token_counts AS
-            SELECT
-                word,
-                COUNT(*) AS count
-            FROM (
-                SELECT regexp_split_to_table(text, E'\\s') AS word
-                FROM processed_articles
-            ) AS subquery
-            GROUP BY word;
-        """
-
-        with engine.connect() as con:
-            con.begin()
-            r1 = con.execute(sqlalchemy.text(clear_table))
-            r2 = con.execute(sqlalchemy.text(count_tokens))
-            con.commit()
\ No newline at end of file
+    # workers clean chunks of articles; this process writes the results
+    start_time = time.time()
+    n_processed = 0
+    n_paragraphs = 0
+    n_cleaned = 0
+    max_id = 0
+    semaphore = Semaphore(n_threads * 4)
+    buffer = []
+    # token frequencies of this run (merged from the workers' counters)
+    token_counts = {plan.fingerprint: Counter() for plan in plans}
+    stats = Counter()
+    with Pool(n_threads, initializer=initializer, initargs=(cache.path if cache else None, )) as pool:
+        results = pool.imap_unordered(partial(clean_chunk, plans=plans, watermarks=watermarks), throttle(chunks, semaphore))
+        progress = tqdm(total=n_articles, desc="Processing", unit="articles")
+        for paragraphs, n_chunk, chunk_max_id, new_items, chunk_token_counts, chunk_stats in results:
+            semaphore.release()
+            stats.update(chunk_stats)
+            for fingerprint, counter in chunk_token_counts.items():
+                token_counts[fingerprint].update(counter)
+            for fingerprint, items in new_items.items():
+                cache.put(fingerprint, items)
+                n_cleaned += len(items)
+            buffer += paragraphs
+            if len(buffer) >= input_args.write_batch_size:
+                write_paragraphs(buffer)
+                buffer = []
+            n_processed += n_chunk
+            max_id = max(max_id, chunk_max_id)
+            n_paragraphs += len(paragraphs)
+            progress.update(n_chunk)
+        write_paragraphs(buffer)
+        progress.close()
+
+    elapsed = time.time() - start_time
+    print(f'Cleaned {n_processed} articles ({n_paragraphs} paragraphs in {len(plans)} variants) in {elapsed:.1f} seconds '
+          f'({n_processed / max(elapsed, 1e-9):.1f} articles/sec)')
+    if cache:
+        print(f"{n_cleaned} paragraphs were cleaned, {stats['cache_hits']} were taken from the cleaning cache")
+        cache.close()
+    n_numbers = stats['number_hits'] + stats['number_misses']
+    if n_numbers:
+        print(f"Number cache: {stats['number_hits']} of {n_numbers} numbers were cached "
+              f"(hit rate {stats['number_hits'] / n_numbers:.1%})")
+
+    print('Writing token frequencies')
+    write_token_frequencies(token_counts)
+    for fingerprint, counter in token_counts.items():
+        print(f'Settings {fingerprint}: {len(counter)} token types, {sum(counter.values())} tokens')
+
+    # all articles up to max_id are written now: the next run only has to process newer articles
+    if max_id and not input_args.debug:
+        for plan in plans:
+            session.merge(CleaningWatermark(settings=plan.fingerprint, scope=scope,
+                                            last_id=max(max_id, watermarks[plan.fingerprint])))
+        session.commit()
+        print(f'Processed all articles up to id {max_id}')
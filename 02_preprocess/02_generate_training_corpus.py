@@ -1,22 +1,61 @@
 import sys
 
 sys.path.append(".")
-import os
-from sqlalchemy import text
 from utils.sql import start_sqlsession
-from utils.datamodel import ProcessedParagraph
+from utils.datamodel import CleaningSettings
+from utils.corpus import ParagraphReader, CorpusWriter, ShuffleWriter, ShardedCorpusWriter, ThreadedWriter, StatsWriter
 from argparse import ArgumentParser
 from tqdm import tqdm
-from sqlalchemy import func
 from pathlib import Path
 from math import ceil
-import random
-
-import pandas as pd
+import json
 
 # start sql
 session, engine = start_sqlsession()
 
+
+def select_settings(fingerprint: str = None) -> str:
+    """
+    Select the variant of processed paragraphs (settings fingerprint) to export.
+    Without a fingerprint, the only variant in the database is used.
+    Note: a variant that was lowercased during cleaning is not the same corpus as
+    a lowercased export (cleaning lowercases before genderstar and repairing separated words),
+    select it explicitly with --settings.
+    """
+    variants = {
+        row.fingerprint: json.loads(row.settings)
+        for row in session.query(CleaningSettings)
+    }
+    if fingerprint is None:
+        if len(variants) != 1:
+            print("Please select the settings with --settings. Available variants:")
+            for fp, settings in variants.items():
+                print(f"  {fp}: {json.dumps(settings)}")
+            sys.exit(1)
+        fingerprint = list(variants.keys())[0]
+    elif fingerprint not in variants:
+        print(f"Unknown settings: {fingerprint}")
+        sys.exit(1)
+    return fingerprint
+
+
+def parse_variant(variant: str, min_length: int) -> dict:
+    """
+    Parse a corpus variant: "<corpus_name>[:<options>]", options are
+    "lowercase" and "min_length=<n>" (default: --min_length), separated by commas
+    """
+    corpus_name, _, options = variant.partition(":")
+    parsed = dict(corpus_name=corpus_name.strip(), lowercase=False, min_length=min_length)
+    for option in filter(None, (option.strip() for option in options.split(","))):
+        if option == "lowercase":
+            parsed["lowercase"] = True
+        elif option.startswith("min_length="):
+            parsed["min_length"] = int(option.split("=", 1)[1])
+        else:
+            raise ValueError(f'Unknown option in variant "{variant}": {option}')
+    return parsed
+
+
 if __name__ == "__main__":
     arg_parser = ArgumentParser(description="Dump SQL to txt files")
     arg_parser.add_argument(
@@ -43,13 +82,48 @@ if __name__ == "__main__":
     arg_parser.add_argument(
         "--seed", type=int, default=1234, help="Seed for shuffling (default: 1234)"
     )
+    arg_parser.add_argument(
+        "--rows_per_bucket",
+        type=int,
+        default=1000000,
+        help="Number of rows shuffled in memory at once (default: 1,000,000 rows)",
+    )
     arg_parser.add_argument(
         "--lowercase",
         action="store_true",
         help="Lowercase entire corpus before saving.",
     )
+    arg_parser.add_argument(
+        "--settings",
+        type=str,
+        default=None,
+        help="Fingerprint of the cleaning settings to export (default: the only variant in the database)",
+    )
+    arg_parser.add_argument(
+        "--shards",
+        type=int,
+        default=0,
+        help="Write the corpus as zstd compressed shards with a manifest into data/<corpus_name>/ (default: 0, one txt file)",
+    )
+    arg_parser.add_argument(
+        "--variant",
+        type=str,
+        action="append",
+        default=[],
+        help="Write several corpora in one pass (can be repeated): corpus name, optionally followed by "
+        'options, e.g., "--variant training_data --variant training_data_lower:lowercase,min_length=10". '
+        "Replaces --corpus_name and --lowercase",
+    )
     input_args = arg_parser.parse_args()
 
+    # all corpora are written from the same paragraphs, lowercasing happens during the export
+    fingerprint = select_settings(input_args.settings)
+    if input_args.variant:
+        variants = [parse_variant(variant, input_args.min_length) for variant in input_args.variant]
+    else:
+        variants = [dict(corpus_name=input_args.corpus_name, lowercase=input_args.lowercase, min_length=input_args.min_length)]
+    print(f"Exporting paragraphs with settings {fingerprint}")
+
     p = Path.cwd()
 
     data_dir = p / "data"
@@ -57,69 +131,64 @@ if __name__ == "__main__":
     if not data_dir.exists():
         data_dir.mkdir()
 
-    output_file = data_dir / f"{input_args.corpus_name}.txt"
-
-    if output_file.exists():
-        os.remove(output_file)
-
-    output_file.touch()
-
-    total_units = (
-        session.query(ProcessedParagraph)
-        .filter(ProcessedParagraph.n_tokens >= input_args.min_length)
-        .count()
-    )
+    """
+        Stream paragraphs page by page (id ranges) and shuffle them globally:
+        each bucket of the shuffle holds about --rows_per_bucket lines in memory.
+        Every corpus (variant) is shuffled and written in its own thread.
+    """
+    min_length = min(variant["min_length"] for variant in variants)
+    reader = ParagraphReader(engine, fingerprint, min_length=min_length)
+    # debug: only a random sample of 100 pages (reproducible with --seed)
+    pages = reader.pages(input_args.batch_size, max_pages=100, seed=input_args.seed) if input_args.debug else None
+    total_units = reader.count(pages)
     print(f"Got {total_units} text units")
-
-    """ If we have PostgreSQL we can leverage its built-in export function """
-    if "postgresql" in engine.dialect.name:
-        print("Using postgres export function...")
-        import psycopg2
-
-        conn = psycopg2.connect(engine.url.render_as_string(hide_password=False))
-        cursor = conn.cursor()
-        query_string = f"SELECT setseed(0.{input_args.seed}); "
-        if input_args.lowercase:
-            query_string += "COPY (SELECT LOWER(text) FROM processed_articles"
+    # all paragraphs of the variant that are read (to calculate how many are dropped by min_length)
+    total_lines = ParagraphReader(engine, fingerprint).count(pages)
+
+    writers = []
+    for variant in variants:
+        n_units = ParagraphReader(engine, fingerprint, min_length=variant["min_length"]).count(pages)
+        n_buckets = ceil(n_units / input_args.rows_per_bucket)
+        if input_args.shards > 0:
+            output_file = data_dir / variant["corpus_name"]
+            metadata = dict(corpus_name=variant["corpus_name"], settings=fingerprint,
+                            min_length=variant["min_length"], seed=input_args.seed)
+            output = ShardedCorpusWriter(output_file, ceil(n_units / input_args.shards),
+                                         lowercase=variant["lowercase"], metadata=metadata)
+            stats_file = output_file / "stats.json"
         else:
-            query_string += "COPY (SELECT text FROM processed_articles"
-        query_string += f" WHERE n_tokens >= {input_args.min_length}"
-        query_string += f" ORDER BY RANDOM()"
-        if input_args.debug:
-            query_string += " LIMIT 300000"
-        query_string += ") TO STDOUT"
-        # query_string += str(output_file.absolute())
-        # query_string += "'"
-        cursor.copy_expert(query_string, open(output_file.absolute(), "w"))
-
-        cursor.close()
-        conn.close()
-
-    else:
-
-        pages = ceil(total_units / input_args.batch_size)
-
-        if input_args.debug:
-            pages = 100
-
-        """
-            Shuffle batches of training data. Smaller batches == more shuffeling
-        """
-        pages = list(range(pages))
-        random.shuffle(pages)
-
-        base_query = session.query(ProcessedParagraph.text).filter(
-            ProcessedParagraph.n_tokens >= input_args.min_length
-        )
-
-        for p in tqdm(pages, total=len(pages), unit="batches"):
-            query = base_query.limit(input_args.batch_size).offset(
-                input_args.batch_size * p
-            )
-            with engine.begin() as con:
-                df = pd.read_sql(query.statement, con)
-            if input_args.lowercase:
-                df.text = df.text.str.lower()
-            df.text.to_csv(output_file, index=False, header=False, mode="a")
+            output_file = data_dir / f"{variant['corpus_name']}.txt"
+            output = CorpusWriter(output_file, lowercase=variant["lowercase"])
+            stats_file = data_dir / f"{variant['corpus_name']}.stats.json"
+        print(f"Writing {n_units} text units to {output_file} (lowercase: {variant['lowercase']}, min_length: {variant['min_length']})")
+        shuffled = ShuffleWriter(output, n_buckets=n_buckets, seed=input_args.seed, tmp_dir=data_dir)
+        metadata = dict(corpus_name=variant["corpus_name"], settings=fingerprint,
+                        min_length=variant["min_length"], seed=input_args.seed, debug=input_args.debug)
+        stats = StatsWriter(shuffled, stats_file, lowercase=variant["lowercase"],
+                            total_lines=total_lines, metadata=metadata)
+        writers.append((variant, output_file, ThreadedWriter(stats)))
+
+    progress = tqdm(total=total_units, unit="rows")
+    for rows in reader.iter_batches(page_size=input_args.batch_size, pages=pages):
+        texts = [text for text, _ in rows]
+        for variant, _, writer in writers:
+            if variant["min_length"] > min_length:
+                writer.write([text for text, n_tokens in rows if n_tokens >= variant["min_length"]])
+            else:
+                writer.write(texts)
+        progress.update(len(rows))
+    progress.close()
+
+    print("Shuffling")
+    # shuffle all corpora in parallel
+    for _, _, writer in writers:
+        writer.finish()
+    for variant, output_file, writer in writers:
+        writer.close()
+        print(f"Wrote {writer.n_lines} lines to {output_file}, statistics: {writer.writer.path}")
+        stats = writer.writer.stats()
+        print(f"  {stats['n_tokens']} tokens, {stats['n_types']} types, "
+              f"{stats['share_dropped']:.1%} of paragraphs shorter than {variant['min_length']} tokens")
+        print("  vocabulary size by min_count: " + ", ".join(f"{row['min_count']}: {row['n_types']}" for row in stats["vocabulary"]))
 
     session.close()
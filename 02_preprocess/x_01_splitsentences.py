@@ -1,7 +1,8 @@
 import sys
 sys.path.append('.')
-from utils.sql import start_sqlsession
-from utils.datamodel import Article, RawSentence
+from utils.sql import start_sqlsession, SQLArticleReader
+from utils.articlestore import start_articlestore
+from utils.datamodel import RawSentence
 from utils.misc import md5sum
 from argparse import ArgumentParser
 import spacy
@@ -11,6 +12,8 @@ from multiprocessing import Pool
 
 # start sql
 session, engine = start_sqlsession()
+# optional: read articles from parquet files instead
+article_store = start_articlestore()
 
 
 def add_if_not_duplicated(sentence: str) -> None:
@@ -31,44 +34,42 @@ def add_if_not_duplicated(sentence: str) -> None:
     local_session.close()
 
 
-def process_headline(article_id: int) -> None:
-    """ Get only article headline and pretitle 
-        and add them as raw sentences
+def add_headlines(article_id: int, pretitle: str, headline: str) -> None:
+    """ add headline and pretitle as raw sentences
         also add them as combined string: pretitle + headline
     """
-    local_session = sessionmaker(bind=engine)()
-    article = local_session.query(Article).filter(Article.id == article_id).first()
-    if article.headline and article.headline != "":
+    if headline and headline != "":
         try:
-            add_if_not_duplicated(article.headline)
+            add_if_not_duplicated(headline)
         except Exception as e:
-            print("Error when adding headline", article.article_id, e)
-    if article.pretitle and article.pretitle != "":
+            print("Error when adding headline", article_id, e)
+    if pretitle and pretitle != "":
         try:
-            add_if_not_duplicated(article.pretitle)
+            add_if_not_duplicated(pretitle)
         except Exception as e:
-            print("Error when adding pretitle", article.article_id, e)
-    if article.pretitle and article.pretitle != "" and article.headline and article.headline != "":
+            print("Error when adding pretitle", article_id, e)
+    if pretitle and pretitle != "" and headline and headline != "":
         try:
-            add_if_not_duplicated(article.pretitle + " " + article.headline)
+            add_if_not_duplicated(pretitle + " " + headline)
         except Exception as e:
-            print("Error when adding pretitle + headline", article.article_id, e)
-    local_session.close()
+            print("Error when adding pretitle + headline", article_id, e)
+
 
-def yield_article(column: str, ids: list) -> str:
-    """ Generator function to return articles 
-        used for spacy to load articles in batches
+def process_headlines(batch: list) -> None:
+    """ Add headlines for a batch of articles (tuples: article_id, pretitle, headline) """
+    for article in batch:
+        add_headlines(*article)
+
+def yield_article(articles, column: str) -> str:
+    """ Generator function to return articles
+        used for spacy to load articles in batches;
+        only the requested column is read
+        (from the parquet store or the SQL database)
     """
-    for a_id in ids:
-        try:
-            local_session = sessionmaker(bind=engine)()
-            article = local_session.query(Article).filter(Article.id == a_id).first()
-            local_session.close()
-            text = getattr(article, column)
+    for batch in articles.iter_batches([column]):
+        for text in batch[column]:
             if text:
                 yield text
-        except Exception as e:
-            pass
 
 def initializer():
     """ensure the parent proc's database connections are not touched
@@ -93,35 +94,34 @@ if __name__ == '__main__':
 
     n_threads = input_args.threads
 
-    # get all article ids and reformat to clean list
-    article_ids = session.query(Article.id).all()
-    article_ids = [a[0] for a in article_ids]
-
+    articles = article_store or SQLArticleReader(engine)
+    print(f'Reading articles from {articles}')
+    n_articles = articles.count()
 
     # first add all headlines and pre-titles (without splitting)
+    headlines = (list(batch[['article_id', 'pretitle', 'headline']].itertuples(index=False, name=None))
+                 for batch in articles.iter_batches(['article_id', 'pretitle', 'headline'], batch_size=1000))
     with Pool(n_threads, initializer=initializer) as p:
-        r = list(tqdm(p.imap(process_headline, article_ids), 
-                      total=len(article_ids),
-                      desc="Headlines"))
-    
+        for _ in tqdm(p.imap(process_headlines, headlines), desc="Headlines", unit="batches"):
+            pass
 
     # load spacy for sentence splitting
     nlp = spacy.load("de_core_news_lg")
     nlp.disable_pipes('ner', 'tagger')
     nlp.enable_pipe('senter')
 
-    docs = nlp.pipe(yield_article("lead_paragraph", article_ids), n_process=n_threads)
-    for doc in tqdm(docs, total=len(article_ids), desc="Lead paragraph"):
+    docs = nlp.pipe(yield_article(articles, "lead_paragraph"), n_process=n_threads)
+    for doc in tqdm(docs, total=n_articles, desc="Lead paragraph"):
         for s in doc.sents:
             add_if_not_duplicated(s.text.strip())
 
-    docs = nlp.pipe(yield_article("description", article_ids), n_process=n_threads)
-    for doc in tqdm(docs, total=len(article_ids), desc="Description"):
+    docs = nlp.pipe(yield_article(articles, "description"), n_process=n_threads)
+    for doc in tqdm(docs, total=n_articles, desc="Description"):
         for s in doc.sents:
             add_if_not_duplicated(s.text.strip())
 
-    docs = nlp.pipe(yield_article("body", article_ids), n_process=n_threads)
-    for doc in tqdm(docs, total=len(article_ids), desc="Article body"):
+    docs = nlp.pipe(yield_article(articles, "body"), n_process=n_threads)
+    for doc in tqdm(docs, total=n_articles, desc="Article body"):
         for s in doc.sents:
             add_if_not_duplicated(s.text.strip())
 
@@ -3,7 +3,7 @@ sys.path.append('.')
 import os
 from sqlalchemy import text
 from utils.sql import start_sqlsession
-from utils.datamodel import Sentence, ProcessedParagraph
+from utils.datamodel import Sentence, ProcessedParagraph, CleaningSettings
 from argparse import ArgumentParser
 from tqdm import tqdm
 from sqlalchemy import func
@@ -24,9 +24,19 @@ if __name__ == '__main__':
     arg_parser.add_argument('--batch_size', type=int, default=10000, help='Number of rows to load per batch (default: 10,000 rows)')
     arg_parser.add_argument('--corpus_name', type=str, default="training_data", help='Name of the corpus file; file extension is added automatically (default "taining_data")')
     arg_parser.add_argument('--seed', type=int, default=1234, help='Seed for shuffling (default: 1234)')
+    arg_parser.add_argument('--settings', type=str, default=None, help='Fingerprint of the cleaning settings to export (default: the only variant in the database)')
     
     input_args = arg_parser.parse_args()
 
+    # processed paragraphs of several cleaning variants can be in the database: only export one
+    fingerprints = [row.fingerprint for row in session.query(CleaningSettings)]
+    fingerprint = input_args.settings
+    if fingerprint is None and len(fingerprints) == 1:
+        fingerprint = fingerprints[0]
+    if fingerprint not in fingerprints:
+        print(f'Please select the settings with --settings. Available variants: {", ".join(fingerprints)}')
+        sys.exit(1)
+
     p = Path.cwd()
 
     data_dir = p / 'data'
@@ -41,7 +51,8 @@ if __name__ == '__main__':
 
     output_file.touch()
 
-    total_units = session.query(ProcessedParagraph).filter(ProcessedParagraph.n_tokens >= input_args.min_length).count()
+    total_units = session.query(ProcessedParagraph).filter(ProcessedParagraph.settings == fingerprint,
+                                                           ProcessedParagraph.n_tokens >= input_args.min_length).count()
     print(f'Got {total_units} text units')
 
     """ If we have PostgreSQL we can leverage its built-in export function """
@@ -52,7 +63,8 @@ if __name__ == '__main__':
         cursor = conn.cursor()
         query_string = f"SELECT setseed(0.{input_args.seed}); "
         query_string += "COPY (SELECT text FROM processed_articles"
-        query_string += f" WHERE n_tokens >= {input_args.min_length}"
+        query_string += f" WHERE settings = '{fingerprint}'"
+        query_string += f" AND n_tokens >= {input_args.min_length}"
         query_string += f" ORDER BY RANDOM()"
         if input_args.debug:
             query_string += " LIMIT 10000"
@@ -6,6 +6,7 @@ import subprocess
 import json
 import re
 import time
+import tempfile
 from argparse import ArgumentParser
 from pathlib import Path
 from dotenv import load_dotenv
@@ -14,6 +15,7 @@ load_dotenv()
 
 from utils.random_names import generate_random_name
 from utils.misc import get_data_dir
+from utils.corpus import reassemble_corpus
 
 import fasttext
 
@@ -21,7 +23,7 @@ if __name__ == "__main__":
 
     arg_parser = ArgumentParser(description="Train a fasttext model")
     arg_parser.add_argument("model_type", type=str, choices=["cbow", "skipgram"])
-    arg_parser.add_argument("training_corpus", type=str, help="Path to training corpus")
+    arg_parser.add_argument("training_corpus", type=str, help="Path to training corpus (txt file or directory of a sharded corpus)")
     arg_parser.add_argument("--debug", action="store_true", help="Debug flag")
     arg_parser.add_argument(
         "--threads",
@@ -37,6 +39,12 @@ if __name__ == "__main__":
     arg_parser.add_argument("--min_count", type=int, default=1)
     arg_parser.add_argument("--window_size", type=int, default=5)
     arg_parser.add_argument("--dimensions", type=int, default=100)
+    arg_parser.add_argument(
+        "--scratch_dir",
+        type=str,
+        default=None,
+        help="Directory for reassembling a sharded corpus, e.g., local disk of the node (default: system temp directory)",
+    )
 
     input_args = arg_parser.parse_args()
 
@@ -130,49 +138,64 @@ if __name__ == "__main__":
         str(input_args.threads),
     ]
 
-    training_start_time = time.time()
+    # fasttext reads the input file several times and every thread seeks to its own offset:
+    # a sharded corpus is decompressed into a temporary file for the duration of the training
+    scratch_dir = None
+    try:
+        if training_corpus.is_dir():
+            scratch_dir = tempfile.TemporaryDirectory(prefix="corpus_", dir=input_args.scratch_dir)
+            input_file = Path(scratch_dir.name) / f"{corpus}.txt"
+            print("Reassembling sharded corpus to", input_file)
+            reassemble_corpus(training_corpus, input_file)
+            command[command.index("-input") + 1] = str(input_file)
 
-    if input_args.debug:
-        print("calling command:", command)
+        training_start_time = time.time()
 
-    p = subprocess.Popen(
-        command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding="utf-8"
-    )
+        if input_args.debug:
+            print("calling command:", command)
 
-    loss_value = 100.0  # pre-allocate
-    progress = 0.0
+        p = subprocess.Popen(
+            command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding="utf-8"
+        )
 
-    while True:
-        realtime_output = p.stdout.readline()
+        loss_value = 100.0  # pre-allocate
+        progress = 0.0
 
-        if realtime_output == "" and p.poll() is not None:
-            break
+        while True:
+            realtime_output = p.stdout.readline()
 
-        if realtime_output:
-            try:
-                new_progress = re.search(r"Progress:\s*(\d+.\d)%", realtime_output)[1]
-                new_progress = float(new_progress)
+            if realtime_output == "" and p.poll() is not None:
+                break
 
-                loss_value = re.search(r"avg\.loss: *(\d\.\d+) *ETA", realtime_output)[
-                    1
-                ]
-                loss_value = float(loss_value)
+            if realtime_output:
+                try:
+                    new_progress = re.search(r"Progress:\s*(\d+.\d)%", realtime_output)[1]
+                    new_progress = float(new_progress)
 
-                words_sec_thread = re.search(r"thread:\s*(\d+)\s", realtime_output)[1]
-                words_sec_thread = float(words_sec_thread)
+                    loss_value = re.search(r"avg\.loss: *(\d\.\d+) *ETA", realtime_output)[
+                        1
+                    ]
+                    loss_value = float(loss_value)
 
-                lr = re.search(r"lr:\s*(\d+\.\d+)\s", realtime_output)[1]
-                lr = float(lr)
+                    words_sec_thread = re.search(r"thread:\s*(\d+)\s", realtime_output)[1]
+                    words_sec_thread = float(words_sec_thread)
 
-                if new_progress != progress:
-                    # only print to console when progress increased
-                    print(realtime_output.strip(), flush=True)
-                    progress = new_progress
+                    lr = re.search(r"lr:\s*(\d+\.\d+)\s", realtime_output)[1]
+                    lr = float(lr)
+
+                    if new_progress != progress:
+                        # only print to console when progress increased
+                        print(realtime_output.strip(), flush=True)
+                        progress = new_progress
 
-            except:
-                print(realtime_output.strip(), flush=True)
+                except:
+                    print(realtime_output.strip(), flush=True)
 
-    computation_time = time.time() - training_start_time
+        computation_time = time.time() - training_start_time
+    finally:
+        # also remove the temporary copy of the corpus if the training fails
+        if scratch_dir is not None:
+            scratch_dir.cleanup()
 
     # test whether model can be loaded
     loaded_model = fasttext.load_model(str(model_path.absolute()) + ".bin")
@@ -2,13 +2,13 @@ import sys
 sys.path.append('.')
 
 from utils.misc import get_data_dir
-from utils.cleaning import clean_text
+from utils.cleaning import get_cleaning_plan, clean_texts
 
+import os
 import re
 from pathlib import Path
 
 import pandas as pd
-import swifter
 
 from argparse import ArgumentParser
 
@@ -35,6 +35,13 @@ for d in [FASTTEXT_DIR, VALIDATION_DIR, TRAINING_DIR]:
 
 print('Preprocessing data')
 
+cleaning_plan = get_cleaning_plan(remove_links=True,
+                                  remove_emails=True,
+                                  remove_emojis=True,
+                                  remove_punctuation=True,
+                                  replace_numbers=True,
+                                  genderstar=True)
+
 for feather in DATA_DIR.glob('*.feather'):
     print(feather)
     df = pd.read_feather(feather)
@@ -51,13 +58,7 @@ for feather in DATA_DIR.glob('*.feather'):
         df['fasttext_label'] = '__label__' + df['label'].str.lower()
 
     
-    df['text_cleaned'] = df['text'].swifter.apply(clean_text, 
-                                                        remove_links=True, 
-                                                        remove_emails=True,
-                                                        remove_emojis=True, 
-                                                        remove_punctuation=True,
-                                                        replace_numbers=True,
-                                                        genderstar=True)
+    df['text_cleaned'] = clean_texts(df['text'], cleaning_plan, processes=os.cpu_count())
 
     df['fasttext_str'] = df.fasttext_label  + ' ' + \
         df['text_cleaned'].str.replace('\n', ' ', regex=False).str.replace('\r', ' ').str.replace('\\n', ' ', regex=False) + '\n'
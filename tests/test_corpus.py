@@ -0,0 +1,102 @@
+import sys
+sys.path.append('.')
+import json
+
+import pytest
+
+from utils.corpus import CorpusWriter, ShuffleWriter, ShardedCorpusWriter, StatsWriter, ThreadedWriter, reassemble_corpus
+
+LINES = [f'line {i} with\ra carriage return' if i % 7 == 0 else f'line {i} ' + 'token ' * (i % 5)
+         for i in range(1000)]
+
+
+def shuffle(path, seed, n_buckets=4, lines=LINES):
+    with ShuffleWriter(CorpusWriter(path), n_buckets=n_buckets, seed=seed, tmp_dir=path.parent) as writer:
+        for start in range(0, len(lines), 100):
+            writer.write(lines[start:start + 100])
+    return writer
+
+
+def read_lines(path):
+    with open(path, encoding='utf-8', newline='') as f:
+        return f.read().split('\n')[:-1]
+
+
+def test_shuffle_keeps_lines(tmp_path):
+    writer = shuffle(tmp_path / 'corpus.txt', seed=1234)
+    lines = read_lines(tmp_path / 'corpus.txt')
+    assert writer.n_lines == len(LINES)
+    assert sorted(lines) == sorted(LINES)
+    assert lines != LINES
+    assert not list(tmp_path.glob('shuffle_*'))
+
+
+def test_shuffle_seed(tmp_path):
+    shuffle(tmp_path / 'a.txt', seed=1234)
+    shuffle(tmp_path / 'b.txt', seed=1234)
+    shuffle(tmp_path / 'c.txt', seed=4321)
+    assert read_lines(tmp_path / 'a.txt') == read_lines(tmp_path / 'b.txt')
+    assert read_lines(tmp_path / 'a.txt') != read_lines(tmp_path / 'c.txt')
+
+
+def test_sharded_writer(tmp_path):
+    pytest.importorskip('zstandard')
+    directory = tmp_path / 'corpus'
+    with ShardedCorpusWriter(directory, lines_per_shard=300, metadata={'seed': 1234}) as writer:
+        for start in range(0, len(LINES), 128):
+            writer.write(LINES[start:start + 128])
+    with open(directory / 'manifest.json') as f:
+        manifest = json.load(f)
+    assert writer.n_lines == len(LINES)
+    assert [shard['n_lines'] for shard in manifest['shards']] == [300, 300, 300, 100]
+    assert manifest['seed'] == 1234
+    reassemble_corpus(directory, tmp_path / 'corpus.txt')
+    assert read_lines(tmp_path / 'corpus.txt') == LINES
+
+
+def test_sharded_writer_existing_directory(tmp_path):
+    pytest.importorskip('zstandard')
+    directory = tmp_path / 'corpus'
+    ShardedCorpusWriter(directory, lines_per_shard=10).close()
+    # an earlier corpus (with manifest) is replaced
+    with ShardedCorpusWriter(directory, lines_per_shard=10) as writer:
+        writer.write(LINES[:5])
+    assert read_lines_manifest(directory) == 5
+    # any other directory is kept
+    (tmp_path / 'other').mkdir()
+    (tmp_path / 'other' / 'file.txt').write_text('keep')
+    with pytest.raises(FileExistsError):
+        ShardedCorpusWriter(tmp_path / 'other', lines_per_shard=10)
+    assert (tmp_path / 'other' / 'file.txt').exists()
+
+
+def read_lines_manifest(directory):
+    with open(directory / 'manifest.json') as f:
+        return sum(shard['n_lines'] for shard in json.load(f)['shards'])
+
+
+def test_stats_writer(tmp_path):
+    lines = ['a b c', 'A b', 'c']
+    with StatsWriter(CorpusWriter(tmp_path / 'corpus.txt', lowercase=True), tmp_path / 'stats.json',
+                     lowercase=True, total_lines=4) as writer:
+        writer.write(lines)
+    with open(tmp_path / 'stats.json') as f:
+        stats = json.load(f)
+    assert writer.n_lines == 3
+    assert stats['n_lines'] == 3
+    assert stats['n_tokens'] == 6
+    assert stats['n_types'] == 3
+    assert stats['n_lines_dropped'] == 1
+    assert stats['line_length']['histogram'] == {'1': 1, '2': 1, '3': 1}
+    assert read_lines(tmp_path / 'corpus.txt') == ['a b c', 'a b', 'c']
+
+
+def test_threaded_writers_finish(tmp_path):
+    writers = [ThreadedWriter(CorpusWriter(tmp_path / f'{i}.txt')) for i in range(3)]
+    for writer in writers:
+        writer.write(LINES)
+        writer.finish()
+    for writer in writers:
+        writer.close()
+    assert all(writer.n_lines == len(LINES) for writer in writers)
+    assert read_lines(tmp_path / '2.txt') == LINES
@@ -0,0 +1,43 @@
+import sys
+sys.path.append('.')
+import hashlib
+
+from utils.dedup import HashIndex
+
+
+def md5(text):
+    return hashlib.md5(text.encode()).hexdigest()
+
+
+def test_hash_index(tmp_path):
+    path = tmp_path / 'my.data_article_md5'
+    index = HashIndex(path)
+    assert index.base_path == tmp_path / 'my.data_article_md5.npy'
+    assert index.log_path == tmp_path / 'my.data_article_md5.log'
+
+    first = [md5(f'article {i}') for i in range(100)]
+    second = [md5(f'article {i}') for i in range(100, 150)]
+    index.add(first)
+    index.save()
+    assert not index.log_path.exists()
+    assert index.contains(first).all()
+    assert not index.contains(second).any()
+
+    # added hashes are found before and after flushing them to the log
+    index.add(second)
+    assert index.contains(second).all()
+    index.flush()
+    assert index.log_path.exists()
+
+    reloaded = HashIndex(path)
+    reloaded.load()
+    assert len(reloaded) == 150
+    assert reloaded.contains(first + second).all()
+    assert not reloaded.contains([md5('article 150')]).any()
+
+    reloaded.save()
+    assert not reloaded.log_path.exists()
+    compacted = HashIndex(path)
+    compacted.load()
+    assert len(compacted) == 150
+    assert compacted.contains(second).all()
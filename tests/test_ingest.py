@@ -0,0 +1,52 @@
+import sys
+sys.path.append('.')
+import lzma
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pytest
+
+from utils.ingest import read_feather, iter_feather_batches, sample_batches
+
+DF = pd.DataFrame({'id': range(250), 'body': [f'article {i}' for i in range(250)]})
+
+
+@pytest.mark.parametrize('version', [1, 2])
+def test_read_feather_versions(tmp_path, version):
+    path = tmp_path / 'articles.feather'
+    feather.write_feather(DF, path, version=version)
+    pd.testing.assert_frame_equal(read_feather(path), DF)
+    batches = list(iter_feather_batches(path, batch_size=100))
+    assert [len(batch) for batch in batches] == [100, 100, 50]
+    pd.testing.assert_frame_equal(pd.concat(batches, ignore_index=True), DF)
+
+
+@pytest.mark.parametrize('version', [1, 2])
+def test_read_compressed_feather(tmp_path, version):
+    path = tmp_path / 'articles.feather'
+    feather.write_feather(DF, path, version=version)
+    compressed = tmp_path / 'articles.feather.xz'
+    compressed.write_bytes(lzma.compress(path.read_bytes()))
+    pd.testing.assert_frame_equal(read_feather(compressed), DF)
+    batches = list(iter_feather_batches(compressed, batch_size=100))
+    pd.testing.assert_frame_equal(pd.concat(batches, ignore_index=True), DF)
+
+
+def test_read_ipc_stream(tmp_path):
+    path = tmp_path / 'articles.arrow'
+    table = pa.Table.from_pandas(DF, preserve_index=False)
+    with pa.OSFile(str(path), 'wb') as sink, pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    pd.testing.assert_frame_equal(read_feather(path), DF)
+
+
+def test_sample_batches():
+    batches = [DF.iloc[start:start + 50] for start in range(0, len(DF), 50)]
+    sample = sample_batches(batches, n=100)
+    assert len(sample) == 100
+    assert sample.id.is_unique
+    assert list(sample.columns) == list(DF.columns)
+    # rows of all batches, not only the first ones
+    assert sample.id.max() >= 200
+    assert len(sample_batches(batches[:1], n=100)) == 50
@@ -0,0 +1,192 @@
+"""
+    Columnar article store: keeps `Article` data as Parquet files,
+    partitioned by `source` and publication year (hive partitioning, e.g.,
+    `source=derstandard/year=2019/part-....parquet`).
+
+    It is a read-mostly alternative to the SQL `articles` table for the
+    preprocessing stages: only the requested columns are read, and filters on
+    `date_published` are pushed down to the Parquet files (whole years are skipped).
+
+    Set `OEMBEDDINGS_ARTICLE_STORE` in your `.env` to the directory of the store,
+    the preprocessing scripts then read articles from it instead of the SQL database.
+    Populate the store from the SQL database with:
+
+    `python3 utils/articlestore.py`
+
+    Only articles with a higher id than the highest id in the store are copied.
+    Deleted or reloaded articles are not noticed this way: if the store does not match
+    the database anymore, the script stops; rebuild the store with `--rebuild`.
+"""
+
+import sys
+sys.path.append('.')
+import os
+import shutil
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import Iterator, List, Optional, Union
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.compute as pc
+from dotenv import load_dotenv
+load_dotenv()
+
+from utils.datamodel import Article
+
+store_path = os.environ.get('OEMBEDDINGS_ARTICLE_STORE', '')
+
+# map python types of the SQL columns to arrow types
+ARROW_TYPES = {int: pa.int64(),
+               float: pa.float64(),
+               str: pa.string(),
+               datetime: pa.timestamp('us')}
+
+ARTICLE_SCHEMA = pa.schema([(col.name, ARROW_TYPES[col.type.python_type])
+                            for col in Article.__table__.columns] + [('year', pa.int32())])
+
+PARTITIONING = ds.partitioning(pa.schema([('source', pa.string()), ('year', pa.int32())]), flavor='hive')
+
+
+def _article_filter(before: Optional[Union[str, datetime]] = None,
+                    after: Optional[Union[str, datetime]] = None,
+                    since_id: Optional[int] = None) -> Optional[pc.Expression]:
+    """ Same semantics as the filters of `SQLArticleReader`: published on or before
+        the day `before` (`< before + 1 day`), on or after the day `after`, and `id > since_id`.
+        The year filter lets the dataset skip whole partitions.
+    """
+    expression = None
+    if since_id:
+        expression = ds.field('id') > since_id
+    if before:
+        before = pd.Timestamp(before).normalize()
+        before_expression = ((ds.field('year') <= before.year) &
+                             (ds.field('date_published') < before + pd.Timedelta(days=1)))
+        expression = before_expression if expression is None else expression & before_expression
+    if after:
+        after = pd.Timestamp(after).normalize()
+        after_expression = (ds.field('year') >= after.year) & (ds.field('date_published') >= after)
+        expression = after_expression if expression is None else expression & after_expression
+    return expression
+
+
+class ParquetArticleStore:
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+
+    def __repr__(self) -> str:
+        return f"<ParquetArticleStore(path={self.path})>"
+
+    def exists(self) -> bool:
+        return self.path.exists() and any(self.path.rglob('*.parquet'))
+
+    def dataset(self) -> ds.Dataset:
+        return ds.dataset(self.path, format='parquet', schema=ARTICLE_SCHEMA, partitioning=PARTITIONING)
+
+    def write(self, df: pd.DataFrame) -> None:
+        """ Append a batch of articles (columns as in the `articles` table, including `id`) """
+        if len(df) == 0:
+            return
+        df = df.copy()
+        df['year'] = pd.to_datetime(df['date_published']).dt.year.astype('Int32')
+        for col in ARTICLE_SCHEMA.names:
+            if col not in df.columns:
+                df[col] = None
+        table = pa.Table.from_pandas(df[ARTICLE_SCHEMA.names], schema=ARTICLE_SCHEMA, preserve_index=False)
+        ds.write_dataset(table, self.path, format='parquet',
+                         partitioning=PARTITIONING,
+                         basename_template=f'part-{uuid.uuid4().hex}-{{i}}.parquet',
+                         existing_data_behavior='overwrite_or_ignore')
+
+    def max_id(self) -> int:
+        """ Highest article id in the store (0 if empty) """
+        if not self.exists():
+            return 0
+        ids = self.dataset().to_table(columns=['id']).column('id')
+        return pc.max(ids).as_py() or 0
+
+    def count(self, before: Optional[str] = None, after: Optional[str] = None, since_id: Optional[int] = None) -> int:
+        if not self.exists():
+            return 0
+        return self.dataset().count_rows(filter=_article_filter(before, after, since_id))
+
+    def iter_batches(self, columns: List[str],
+                     before: Optional[str] = None,
+                     after: Optional[str] = None,
+                     batch_size: int = 10000,
+                     since_id: Optional[int] = None,
+                     ids: Optional[List[int]] = None) -> Iterator[pd.DataFrame]:
+        """ Stream articles as DataFrames with the `id` and the requested columns.
+            Only these columns are read from disk, and the date filters
+            are evaluated while scanning the files.
+            `since_id`: only articles with a higher id (e.g., added since the last run)
+            `ids`: only these articles (e.g., a random sample)
+        """
+        if not self.exists():
+            return
+        columns = ['id'] + [col for col in columns if col != 'id']
+        expression = _article_filter(before, after, since_id)
+        if ids is not None:
+            ids_expression = ds.field('id').isin(ids)
+            expression = ids_expression if expression is None else expression & ids_expression
+        scanner = self.dataset().scanner(columns=columns,
+                                         filter=expression,
+                                         batch_size=batch_size)
+        for batch in scanner.to_batches():
+            if batch.num_rows > 0:
+                yield batch.to_pandas()
+
+
+def start_articlestore(path: str = store_path) -> Optional[ParquetArticleStore]:
+    """ Returns the Parquet article store if one is configured, otherwise None (use SQL) """
+    if not path:
+        return None
+    return ParquetArticleStore(path)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    from sqlalchemy import select, func
+    from tqdm import tqdm
+    from utils.sql import start_sqlsession
+
+    arg_parser = ArgumentParser(description="Copy articles from the SQL database to the Parquet article store")
+    arg_parser.add_argument('--path', type=str, default=store_path, help='Directory of the article store (default: OEMBEDDINGS_ARTICLE_STORE)')
+    arg_parser.add_argument('--batch_size', type=int, default=50000, help='Number of articles per batch (default: 50,000)')
+    arg_parser.add_argument('--rebuild', action='store_true', help='Delete the store and copy all articles again')
+    input_args = arg_parser.parse_args()
+
+    assert input_args.path, 'No path for the article store given. Set OEMBEDDINGS_ARTICLE_STORE or use --path'
+
+    store = ParquetArticleStore(input_args.path)
+    session, engine = start_sqlsession()
+
+    if input_args.rebuild and store.path.exists():
+        print(f'Deleting {store.path}')
+        shutil.rmtree(store.path)
+
+    # only copy articles that are not in the store yet
+    last_id = store.max_id()
+    # articles that were deleted or reloaded (new ids) since the last copy
+    with engine.connect() as con:
+        n_articles = con.execute(select(func.count(Article.id)).where(Article.id <= last_id)).scalar()
+    if n_articles != store.count():
+        print(f'The store does not match the database anymore ({store.count()} articles in the store, '
+              f'{n_articles} in the database with id <= {last_id}). Rebuild the store with --rebuild')
+        sys.exit(1)
+    print(f'Copying articles with id > {last_id} to {store.path}')
+    progress = tqdm(unit="articles")
+    while True:
+        query = select(Article.__table__).where(Article.id > last_id).order_by(Article.id).limit(input_args.batch_size)
+        with engine.connect() as con:
+            df = pd.read_sql(query, con)
+        if len(df) == 0:
+            break
+        store.write(df)
+        last_id = int(df.id.max())
+        progress.update(len(df))
+    progress.close()
+    session.close()
@@ -1,7 +1,16 @@
 import re
+import json
+import hashlib
 import emoji
 import unicodedata
 import num2words
+from functools import lru_cache
+from multiprocessing import Pool
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+if TYPE_CHECKING:
+    # optional: clean_texts also accepts Arrow string arrays
+    import pyarrow as pa
 # regular expressions to clean raw sentences.
 # We follow the procedures that the Facebook engineers used for fasttext:
 # References:
@@ -55,7 +64,325 @@ REPAIR_SEPARATION = re.compile(r"(\b[äöüÄÖÜa-zA-Z][äöüa-z]+?)([ÄÖÜA-
 
 # Other helper to quickly identify text with wrong encoding
 wrong_encoding = ["â€ž", "Ã¶", "Ã¼", "Ã¼", "Ã¤", "â€"]
+# all indicators combined: scan a text only once
+WRONG_ENCODING = re.compile("|".join(re.escape(indicator) for indicator in dict.fromkeys(wrong_encoding)))
+
+
+# all characters of the basic multilingual plane (all character classes above are within it)
+BMP = "".join(map(chr, range(0x10000)))
+
+# line breaks and runs of whitespace are both replaced by a single space (LINE_BREAKS + WHITESPACE in one pass)
+LINE_BREAKS_WHITESPACE = re.compile(r'\s{2,}|\n')
+
+
+def _char_table(regex: re.Pattern, replacement: str) -> Dict[int, str]:
+    """ Character table that does the same as `regex.sub(replacement, text)`
+        for a regex that matches single characters.
+    """
+    return {ord(char): regex.sub(replacement, char) for char in set(m.group(0) for m in regex.finditer(BMP))}
+
+
+def _compose(first: Dict[int, str], second: Dict[int, str]) -> Dict[int, str]:
+    """ Character table that is equivalent to applying `first` and then `second` """
+    table = {code: "".join(second.get(ord(char), char) for char in replacement)
+             for code, replacement in first.items()}
+    for code, replacement in second.items():
+        table.setdefault(code, replacement)
+    return table
+
+
+def _char_class(codes: Iterable[int]) -> str:
+    """ Regex character class for a set of code points (consecutive code points as ranges) """
+    codes = sorted(codes)
+    ranges = []
+    for code in codes:
+        if ranges and ranges[-1][1] == code - 1:
+            ranges[-1][1] = code
+        else:
+            ranges.append([code, code])
+    return "[" + "".join(re.escape(chr(start)) if start == end else re.escape(chr(start)) + "-" + re.escape(chr(end))
+                         for start, end in ranges) + "]"
+
+
+# non-ASCII characters that occur in any emoji: texts without them are not changed by `emoji.replace_emoji`
+EMOJI_CHARACTERS = frozenset(char for char in "".join(emoji.EMOJI_DATA.keys()) if ord(char) > 127)
+
+
+# quick checks: can a step change the text at all?
+def _has_html(text: str) -> bool:
+    return "<" in text
+
+def _has_links(text: str) -> bool:
+    return "www." in text or "http" in text or "pic" in text
+
+def _has_emails(text: str) -> bool:
+    return "@" in text
+
+def _has_gender(text: str) -> bool:
+    # GENDERSTAR and GENDER_SUFFIX both require "[Ii]nnen"
+    return "nnen" in text
+
+def _has_emojis(text: str) -> bool:
+    return not text.isascii() and not EMOJI_CHARACTERS.isdisjoint(text)
+
+def _has_star_colon_underscore(text: str) -> bool:
+    return "*" in text or ":" in text or "_" in text
+
+def _has_hyphens(text: str) -> bool:
+    return "-" in text
+
+
+class CharReplacer:
+    """ Replace single characters according to a table (code point -> replacement string)
+        in one pass over the text.
+        Same result as `str.translate(table)`, but the text is scanned with a regex
+        character class, which is much faster when only few characters have to be replaced.
+    """
 
+    def __init__(self, table: Dict[int, str]):
+        self.table = {chr(code): replacement for code, replacement in table.items()}
+        self.regex = re.compile(_char_class(table.keys()))
+        replacements = set(self.table.values())
+        if len(replacements) == 1 and "\\" not in next(iter(replacements)):
+            # all characters get the same replacement: no python callback needed
+            self.replacement = replacements.pop()
+        else:
+            self.replacement = lambda m: self.table[m.group(0)]
+
+    def __call__(self, text: str) -> str:
+        return self.regex.sub(self.replacement, text)
+
+
+# numbers as words: num2words is slow, but news articles repeat the same numbers and years all the time
+NUMBER_CACHE_SIZE = 2 ** 16
+
+
+@lru_cache(maxsize=NUMBER_CACHE_SIZE)
+def number_words(digits: str) -> str:
+    """ German words for a number given as string of digits: "2019" -> "zweitausendneunzehn" """
+    return num2words.num2words(digits + " ", lang="de")
+
+
+def number_words_cache_info() -> Dict[str, float]:
+    """ Statistics of the number cache (of the current process) """
+    info = number_words.cache_info()
+    requests = info.hits + info.misses
+    return {'hits': info.hits,
+            'misses': info.misses,
+            'size': info.currsize,
+            'hit_rate': info.hits / requests if requests > 0 else 0.0}
+
+
+def _replace_number(match: re.Match) -> str:
+    return " " + number_words(match.group(0))
+
+
+# increase when the cleaning rules change: results cached with an older version are not used anymore
+CLEANING_VERSION = 1
+
+# default settings of `clean_text` / `CleaningPlan`
+CLEANING_DEFAULTS = dict(lowercase=False,
+                         remove_links=True,
+                         remove_emails=True,
+                         remove_emojis=True,
+                         remove_punctuation=True,
+                         remove_numbers=False,
+                         replace_numbers=True,
+                         remove_quotations=False,
+                         genderstar=True,
+                         repair_separation=True)
+
+
+class CleaningPlan:
+    """ All cleaning steps for one combination of settings, compiled once.
+
+        Character-level replacements are merged into one table per step (`CharReplacer`),
+        steps that cannot match a text are skipped (e.g., no hyphen in the text).
+        The result is exactly the same as applying all regular expressions one after another.
+        Use `get_cleaning_plan(**settings)` to get a cached plan.
+    """
+
+    def __init__(self,
+                 lowercase=False,
+                 remove_links=True,
+                 remove_emails=True,
+                 remove_emojis=True,
+                 remove_punctuation=True,
+                 remove_numbers=False,
+                 replace_numbers=True,
+                 remove_quotations=False,
+                 genderstar=True,
+                 repair_separation=True):
+        self.settings = dict(lowercase=lowercase,
+                             remove_links=remove_links,
+                             remove_emails=remove_emails,
+                             remove_emojis=remove_emojis,
+                             remove_punctuation=remove_punctuation,
+                             remove_numbers=remove_numbers,
+                             replace_numbers=replace_numbers,
+                             remove_quotations=remove_quotations,
+                             genderstar=genderstar,
+                             repair_separation=repair_separation)
+
+        # unusual whitespace and non-breaking markers
+        whitespace = {ord(char): " " for char in UNUSUAL_WHITESPACE}
+        whitespace.update({ord(char): "" for char in NONBREAKING})
+
+        # weird symbols, non-Latin scripts and currency symbols
+        symbols = {}
+        for regex in (SYMBOLS, HEBREW, ARABIC, CYRILLIC, CHINESE):
+            symbols.update(_char_table(regex, " "))
+        symbols.update({ord("€"): "Euro", ord("$"): "Dollar"})
+
+        # punctuation and quotation marks
+        if remove_punctuation:
+            punctuation = _char_table(PUNCTUATION if genderstar else PUNCTUATION_ALL, " ")
+        else:
+            # pad punctuation with whitespace
+            punctuation = _char_table(PUNCTUATION, r' \1 ')
+        # pad quotation marks and normalize
+        quotations = _char_table(QUOTATION_MARKS, " " if remove_quotations else r' " ')
+        punctuation = _compose(punctuation, quotations)
+
+        whitespace = CharReplacer(whitespace)
+        symbols = CharReplacer(symbols)
+        punctuation = CharReplacer(punctuation)
+
+        # (name, function, trigger) in the order they are applied.
+        # The trigger tells if a step can change a text at all (None: always apply it);
+        # false positives are fine, it must never miss a text that would be changed.
+        self.steps: List[Tuple[str, Callable[[str], str], Optional[Callable[[str], bool]]]] = []
+        self.steps.append(('html', self._html, _has_html))
+        self.steps.append(('whitespace', whitespace, whitespace.regex.search))
+        self.steps.append(('normalize', lambda text: unicodedata.normalize("NFKC", text),
+                           lambda text: not unicodedata.is_normalized("NFKC", text)))
+        if remove_links:
+            self.steps.append(('links', self._links, _has_links))
+        if remove_emails:
+            self.steps.append(('emails', self._emails, _has_emails))
+        self.steps.append(('symbols', symbols, symbols.regex.search))
+        if lowercase:
+            self.steps.append(('lowercase', str.lower, None))
+        if genderstar:
+            self.steps.append(('genderstar', self._genderstar, _has_gender))
+        if remove_emojis:
+            self.steps.append(('emojis', self._emojis, _has_emojis))
+        self.steps.append(('punctuation', punctuation, punctuation.regex.search))
+        if replace_numbers:
+            self.steps.append(('replace_numbers', lambda text: NUMBERS.sub(_replace_number, text), NUMBERS.search))
+        if remove_numbers:
+            self.steps.append(('remove_numbers', lambda text: NUMBERS.sub("", text), NUMBERS.search))
+        if genderstar:
+            # another pass at the end; remove other forms of star/colons
+            self.steps.append(('star_colon_underscore', self._star_colon_underscore, _has_star_colon_underscore))
+        self.steps.append(('hyphens', self._hyphens, _has_hyphens))
+        if repair_separation:
+            self.steps.append(('repair_separation', lambda text: REPAIR_SEPARATION.sub(r"\1 \2", text), None))
+        self.steps.append(('whitespace_runs', lambda text: LINE_BREAKS_WHITESPACE.sub(" ", text), None))
+
+    def __repr__(self) -> str:
+        return f"<CleaningPlan({', '.join(f'{k}={v}' for k, v in self.settings.items())})>"
+
+    @property
+    def fingerprint(self) -> str:
+        """ Short hash of the settings (and `CLEANING_VERSION`), identifies the cleaned variant of a text """
+        settings = json.dumps({'version': CLEANING_VERSION, **self.settings}, sort_keys=True)
+        return hashlib.md5(settings.encode('utf-8')).hexdigest()[:16]
+
+    def __reduce__(self):
+        # the steps cannot be pickled: rebuild the plan from the settings (e.g., in a worker process)
+        return (_plan_from_settings, (tuple(self.settings.items()), ))
+
+    @staticmethod
+    def _html(text: str) -> str:
+        if not _has_html(text):
+            return text
+        return HTML_FRAGMENTS.sub(" ", text)
+
+    @staticmethod
+    def _links(text: str) -> str:
+        if not _has_links(text):
+            return text
+        return LINK_REGEX.sub(" ", text)
+
+    @staticmethod
+    def _emails(text: str) -> str:
+        if not _has_emails(text):
+            return text
+        return EMAIL_REGEX.sub(" ", text)
+
+    @staticmethod
+    def _genderstar(text: str) -> str:
+        # preserve genderstar (normalize with underscore)
+        if "nnen" in text and _has_star_colon_underscore(text):
+            text = GENDERSTAR.sub(r"\1_\3", text)
+        if "Innen" in text:
+            text = GENDER_SUFFIX.sub(lambda m: m.group(1) + "_" + m.group(2).lower(), text)
+        return text
+
+    @staticmethod
+    def _emojis(text: str) -> str:
+        if not _has_emojis(text):
+            return text
+        return emoji.replace_emoji(text, " ")
+
+    @staticmethod
+    def _star_colon_underscore(text: str) -> str:
+        if not _has_star_colon_underscore(text):
+            return text
+        return STAR_COLON_UNDERSCORE.sub("", text)
+
+    @staticmethod
+    def _hyphens(text: str) -> str:
+        # handle hyphenated words
+        # preserve: "E-Mail" -> "E-Mail"
+        # otherwise remove hyphens: "EU-Beitritt" -> "EU Beitritt"
+        if not _has_hyphens(text):
+            return text
+        text = HYPHENATED.sub(r"\1 \2", text)
+        text = HYPHEN_PREFIX.sub(r" \2 ", text)
+        text = HYPHEN_SUFFIX.sub(r"\1 ", text)
+        text = HYPHEN_ISOLATED.sub(r" ", text)
+        if not _has_hyphens(text):
+            return text
+        text = HYPHENATED.sub(r"\1 \2", text)
+        text = HYPHENATED.sub(r"\1 \2", text)
+        text = HYPHEN_STARTSEQUENCE.sub(" ", text)
+        return HYPHEN_LEFTOVER.sub(" ", text)
+
+    def clean(self, text: str) -> str:
+        if not text:
+            return ""
+        for _, step, _ in self.steps:
+            text = step(text)
+        return text.strip()
+
+    def clean_batch(self, texts: List[str]) -> List[str]:
+        """ Clean a list of texts step by step.
+            A step is skipped for the whole batch if its trigger does not match
+            any of the texts (e.g., no digits: no number handling).
+        """
+        texts = [text or "" for text in texts]
+        for _, step, trigger in self.steps:
+            if trigger is not None and not trigger("\n".join(texts)):
+                continue
+            texts = [step(text) for text in texts]
+        return [text.strip() for text in texts]
+
+    __call__ = clean
+
+
+@lru_cache(maxsize=None)
+def _plan_from_settings(settings: Tuple[Tuple[str, bool], ...]) -> CleaningPlan:
+    return CleaningPlan(**dict(settings))
+
+
+def get_cleaning_plan(**settings) -> CleaningPlan:
+    """ Cached `CleaningPlan` (building the tables takes a moment).
+        Settings that are not given take the default value.
+    """
+    settings = {**CLEANING_DEFAULTS, **settings}
+    return _plan_from_settings(tuple(settings.items()))
 
 
 def clean_text(text: str,
@@ -69,93 +396,48 @@ def clean_text(text: str,
                      remove_quotations=False,
                      genderstar=True,
                      repair_separation=True) -> str:
-    
+
     if not text:
         return ""
-    
-    text = HTML_FRAGMENTS.sub(" ", text)
 
-    # handle unnusual whitespace
-    for char in UNUSUAL_WHITESPACE:
-        text = text.replace(char, " ")
-    # handle non-breaking markers
-    for char in NONBREAKING:
-        text = text.replace(char, "")
-
-    text = unicodedata.normalize("NFKC", text)
-    
-    if remove_links:
-        text = LINK_REGEX.sub(" ", text)
-    if remove_emails:
-        text = EMAIL_REGEX.sub(" ", text)
-
-    # remove weird symbols
-    text = SYMBOLS.sub(" ", text)
-
-    # remove non-Latin scripts
-    text = HEBREW.sub(" ", text)
-    text = ARABIC.sub(" ", text)
-    text = CYRILLIC.sub(" ", text)
-    text = CHINESE.sub(" ", text)
-
-    # replace currency symbols:
-    text = text.replace("€", "Euro")
-    text = text.replace("$", "Dollar")
-    
-    if lowercase:
-        text = text.lower()
-
-    if genderstar:
-        # preserve genderstar (normalize with underscore)
-        text = GENDERSTAR.sub(r"\1_\3", text)
-        text = GENDER_SUFFIX.sub(lambda m: m.group(1) + "_" + m.group(2).lower(), text)
-    
-    if remove_emojis:
-        text = emoji.replace_emoji(text, " ")
-    if remove_punctuation:
-        if genderstar:
-            text = PUNCTUATION.sub(" ", text)
-        else:
-            text = PUNCTUATION_ALL.sub(" ", text)
-        
-    else:
-        # pad punctuation with whitespace
-        text = PUNCTUATION.sub(r' \1 ', text)
-    if remove_quotations:
-        text = QUOTATION_MARKS.sub(" ", text)
+    plan = get_cleaning_plan(lowercase=lowercase,
+                             remove_links=remove_links,
+                             remove_emails=remove_emails,
+                             remove_emojis=remove_emojis,
+                             remove_punctuation=remove_punctuation,
+                             remove_numbers=remove_numbers,
+                             replace_numbers=replace_numbers,
+                             remove_quotations=remove_quotations,
+                             genderstar=genderstar,
+                             repair_separation=repair_separation)
+    return plan.clean(text)
+
+
+def clean_texts(batch: Union[List[str], "pa.Array"],
+                plan: Optional[CleaningPlan] = None,
+                processes: int = 1,
+                chunk_size: int = 1000) -> Union[List[str], "pa.Array"]:
+    """ Clean many texts at once (a list, pandas Series or Arrow string array).
+        Returns a list, or an Arrow string array if the input is an Arrow array.
+        The texts are cleaned in chunks (`CleaningPlan.clean_batch`),
+        with `processes` > 1 the chunks are distributed to a process pool.
+        Default plan: default settings of `clean_text`.
+    """
+    if plan is None:
+        plan = get_cleaning_plan()
+    is_arrow = hasattr(batch, 'to_pylist')
+    texts = batch.to_pylist() if is_arrow else list(batch)
+    chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+    if processes > 1 and len(chunks) > 1:
+        with Pool(processes) as pool:
+            cleaned = pool.map(plan.clean_batch, chunks)
     else:
-        # pad quotation marks and normalize
-        text = QUOTATION_MARKS.sub(r' " ', text)
-
-    if replace_numbers:
-        text = NUMBERS.sub(lambda m: " " + num2words.num2words(m.group(0) + " ", lang="de"), text)
-
-    if remove_numbers:
-        text = NUMBERS.sub("", text)
-    
-    if genderstar:
-        # another pass at the end; remove other forms of star/colons
-        text = STAR_COLON_UNDERSCORE.sub("", text)
-
-    # handle hyphenated words
-    # preserve: "E-Mail" -> "E-Mail"
-    # otherwise remove hyphens: "EU-Beitritt" -> "EU Beitritt"
-    text = HYPHENATED.sub(r"\1 \2", text)
-    text = HYPHEN_PREFIX.sub(r" \2 ", text)
-    text = HYPHEN_SUFFIX.sub(r"\1 ", text)
-    text = HYPHEN_ISOLATED.sub(r" ", text)
-    text = HYPHENATED.sub(r"\1 \2", text)
-    text = HYPHENATED.sub(r"\1 \2", text)
-    text = HYPHEN_STARTSEQUENCE.sub(" ", text)
-    text = HYPHEN_LEFTOVER.sub(" ", text)
-
-    if repair_separation:
-        text = REPAIR_SEPARATION.sub(r"\1 \2", text)
-
-
-    text = LINE_BREAKS.sub(" ", text)
-    text = WHITESPACE.sub(" ", text)
-    return text.strip()
+        cleaned = [plan.clean_batch(chunk) for chunk in chunks]
+    cleaned = [text for chunk in cleaned for text in chunk]
+    if is_arrow:
+        import pyarrow as pa
+        return pa.array(cleaned, type=pa.string())
+    return cleaned
     
 
 if __name__ == "__main__":
@@ -279,4 +561,24 @@ if __name__ == "__main__":
     assert clean_text("Ćevapčići") == "Ćevapčići", clean_text("Ćevapčići")
     assert clean_text("Über\xadleben") == "Überleben", clean_text("Über\xadleben") 
 
+    # other settings (compiled cleaning plan)
+    assert clean_text(t1, remove_punctuation=False) == 'Amazon prüft " weitere Konsequenzen " . . . .', clean_text(t1, remove_punctuation=False)
+    t7_a = clean_text(t7, remove_punctuation=False, remove_quotations=True, remove_links=False)
+    assert t7_a == 'determined not to give up https / / t . co / gocoksp Av sechs pic . twitter . com / gl Ht zweid PeRA — The Daily Beast', t7_a
+    t19 = "Kosten: 5 € bzw. 6$ – laut Ärzt*innen «sehr» günstig 👍🏽 (ﬁnal)\nneue Zeile"
+    assert clean_text(t19) == 'Kosten fünf Euro bzw sechs Dollar laut Ärzt_innen " sehr " günstig final neue Zeile', clean_text(t19)
+    t19_a = clean_text(t19, lowercase=True, genderstar=False, replace_numbers=False, remove_numbers=True)
+    assert t19_a == 'kosten euro bzw dollar laut ärzt innen " sehr " günstig final neue zeile', t19_a
+    assert get_cleaning_plan(lowercase=True) is get_cleaning_plan(lowercase=True)
+
+    # cached number words
+    assert number_words("2019") == "zweitausendneunzehn", number_words("2019")
+    assert number_words_cache_info()['hits'] > 0
+
+    # batch cleaning: same result as cleaning every text separately
+    batch = [t1, t2, None, "", t9, t14, t15, t16, t17, t18, t19]
+    plan = get_cleaning_plan(remove_punctuation=False)
+    assert clean_texts(batch, plan, chunk_size=4) == [plan.clean(t) for t in batch], clean_texts(batch, plan, chunk_size=4)
+    assert clean_texts(["keine Zahlen", "x-y"]) == [clean_text("keine Zahlen"), clean_text("x-y")]
+
     print('All tests passed!')
\ No newline at end of file
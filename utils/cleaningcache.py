@@ -0,0 +1,118 @@
+"""
+    Persistent cache for cleaned texts: maps (fingerprint of the cleaning settings,
+    md5 of the raw text) to the cleaned text.
+
+    Re-running the cleaning (e.g., after `--clean_database`) or trying another
+    combination of settings only cleans texts that are not in the cache yet.
+    The cache is a SQLite file (stdlib `sqlite3`, one table, no row ids)
+    and is stored next to the database; it can be deleted at any time.
+
+    Several processes can read the cache at the same time (WAL mode),
+    only one process should write to it.
+"""
+
+import os
+import sqlite3
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+from utils.cleaning import CleaningPlan, clean_texts
+from utils.misc import md5sum_batch
+
+# maximum number of parameters per query (SQLite default limit is 999)
+MAX_PARAMETERS = 900
+
+
+class CleaningCache:
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self._connection: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+        # texts requested with `get` that were (not) in the cache (of the current process)
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self) -> str:
+        return f"<CleaningCache(path={self.path})>"
+
+    def __getstate__(self) -> dict:
+        # connections cannot be sent to other processes: only send the path
+        return {'path': self.path}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state['path'])
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """ Connection of the current process (opened on first use, also after a fork) """
+        if self._connection is None or self._pid != os.getpid():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(self.path, timeout=60)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS cleaned_texts ('
+                                     'settings TEXT NOT NULL, '
+                                     'md5 BLOB NOT NULL, '
+                                     'text TEXT NOT NULL, '
+                                     'PRIMARY KEY (settings, md5)) WITHOUT ROWID')
+            self._connection.commit()
+            self._pid = os.getpid()
+        return self._connection
+
+    def get(self, fingerprint: str, hexdigests: List[str]) -> Dict[str, str]:
+        """ Cleaned texts for the given md5 sums of raw texts (hex), only those that are in the cache """
+        cleaned = {}
+        digests = list({bytes.fromhex(hexdigest) for hexdigest in hexdigests})
+        for i in range(0, len(digests), MAX_PARAMETERS):
+            chunk = digests[i:i + MAX_PARAMETERS]
+            query = (f"SELECT md5, text FROM cleaned_texts "
+                     f"WHERE settings = ? AND md5 IN ({', '.join('?' * len(chunk))})")
+            for digest, text in self.connection.execute(query, [fingerprint] + chunk):
+                cleaned[digest.hex()] = text
+        self.hits += len(cleaned)
+        self.misses += len(digests) - len(cleaned)
+        return cleaned
+
+    def put(self, fingerprint: str, items: Iterable[Tuple[str, str]]) -> None:
+        """ Add (md5 sum of raw text (hex), cleaned text) pairs """
+        self.connection.executemany("INSERT OR IGNORE INTO cleaned_texts (settings, md5, text) VALUES (?, ?, ?)",
+                                    ((fingerprint, bytes.fromhex(hexdigest), text) for hexdigest, text in items))
+        self.connection.commit()
+
+    def clean_texts(self, texts: List[Optional[str]], plan: CleaningPlan,
+                    hexdigests: Optional[List[Optional[str]]] = None) -> Tuple[List[str], List[Tuple[str, str]]]:
+        """ Like `utils.cleaning.clean_texts`, but only cleans texts that are not in the cache.
+            Returns the cleaned texts and the new (md5 sum of raw text, cleaned text) pairs;
+            the caller adds them to the cache with `put` (only one process writes).
+            `hexdigests`: md5 sums of the raw texts, if already calculated.
+        """
+        if hexdigests is None:
+            hexdigests = md5sum_batch(texts)
+        cached = self.get(plan.fingerprint, [hexdigest for hexdigest in hexdigests if hexdigest is not None])
+        # clean each missing text only once (texts without md5 sum are missing values)
+        missing = {}
+        for i, hexdigest in enumerate(hexdigests):
+            if hexdigest is not None and hexdigest not in cached:
+                missing.setdefault(hexdigest, texts[i])
+        new_items = list(zip(missing.keys(), clean_texts(list(missing.values()), plan)))
+        cached.update(new_items)
+        return [cached[hexdigest] if hexdigest is not None else "" for hexdigest in hexdigests], new_items
+
+    def count(self, fingerprint: Optional[str] = None) -> int:
+        if fingerprint is None:
+            return self.connection.execute("SELECT COUNT(*) FROM cleaned_texts").fetchone()[0]
+        return self.connection.execute("SELECT COUNT(*) FROM cleaned_texts WHERE settings = ?", (fingerprint, )).fetchone()[0]
+
+    def clear(self, fingerprint: Optional[str] = None) -> None:
+        """ Remove all cached texts (of one combination of settings) """
+        if fingerprint is None:
+            self.connection.execute("DELETE FROM cleaned_texts")
+        else:
+            self.connection.execute("DELETE FROM cleaned_texts WHERE settings = ?", (fingerprint, ))
+        self.connection.commit()
+
+    def close(self) -> None:
+        if self._connection is not None and self._pid == os.getpid():
+            self._connection.close()
+        self._connection = None
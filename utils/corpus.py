@@ -0,0 +1,483 @@
+"""
+    Export processed paragraphs (table `processed_articles`) as training corpus:
+    one paragraph per line, the format fastText expects.
+
+    Paragraphs are read in pages of `id` ranges (`WHERE id > lo AND id <= hi`).
+    Every page is an index range scan, so the export time grows linearly
+    with the size of the table (unlike `LIMIT ... OFFSET ...`, which scans all skipped rows).
+    Rows of a page are streamed (server-side cursor where the database supports it)
+    and written through a buffered writer.
+
+    The corpus is shuffled with a two-pass bucket shuffle (`ShuffleWriter`):
+    the first pass sends every line to a random bucket (temporary file),
+    the second pass shuffles every bucket in memory and writes them one after another.
+    The result is a uniformly random permutation of all lines (reproducible with the same seed),
+    only one bucket has to fit into memory.
+
+    Instead of one text file, the corpus can be written as zstd compressed shards
+    with a manifest (`ShardedCorpusWriter`); `reassemble_corpus` restores the text file
+    (e.g., on the local disk of a compute node right before training).
+
+    Several corpora (e.g., cased and lowercased) can be written from one scan of the table:
+    every corpus gets its own writer in a background thread (`ThreadedWriter`).
+
+    `StatsWriter` collects statistics of a corpus while it is written (tokens, types,
+    line lengths, vocabulary size by fastText's `minCount`) and saves them as JSON sidecar.
+"""
+
+import hashlib
+import json
+import queue
+import shutil
+import tempfile
+import threading
+from collections import Counter
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+from sqlalchemy import select, func, and_, or_
+from sqlalchemy.engine import Engine
+
+from utils.datamodel import ProcessedParagraph
+
+
+class ParagraphReader:
+    """ Stream the texts (and number of tokens) of processed paragraphs of one variant (settings fingerprint) """
+
+    def __init__(self, engine: Engine, settings: str, min_length: int = 0):
+        self.engine = engine
+        self.settings = settings
+        self.min_length = min_length
+
+    def __repr__(self) -> str:
+        return f"<ParagraphReader(settings={self.settings}, min_length={self.min_length})>"
+
+    def _filter(self, query):
+        return query.where(ProcessedParagraph.settings == self.settings,
+                           ProcessedParagraph.n_tokens >= self.min_length)
+
+    def count(self, pages: Optional[List[Tuple[int, int]]] = None) -> int:
+        """ Number of paragraphs (only in the given pages) """
+        query = self._filter(select(func.count(ProcessedParagraph.id)))
+        if pages is not None:
+            query = query.where(or_(*[and_(ProcessedParagraph.id > lo, ProcessedParagraph.id <= hi) for lo, hi in pages]))
+        with self.engine.connect() as con:
+            return con.execute(query).scalar()
+
+    def pages(self, page_size: int, max_pages: Optional[int] = None, seed: Optional[int] = None) -> List[Tuple[int, int]]:
+        """ Split the id range of the variant into pages (lo, hi] of `page_size` ids.
+            `max_pages`: only a random sample of pages (reproducible with `seed`, e.g., for debugging)
+        """
+        query = self._filter(select(func.min(ProcessedParagraph.id), func.max(ProcessedParagraph.id)))
+        with self.engine.connect() as con:
+            min_id, max_id = con.execute(query).one()
+        if min_id is None:
+            return []
+        pages = [(lo, min(lo + page_size, max_id)) for lo in range(min_id - 1, max_id, page_size)]
+        if max_pages is not None and max_pages < len(pages):
+            sample = np.random.default_rng(seed).choice(len(pages), size=max_pages, replace=False)
+            pages = [pages[i] for i in sorted(sample)]
+        return pages
+
+    def iter_page(self, lo: int, hi: int, batch_size: int = 10000) -> Iterator[List[Tuple[str, int]]]:
+        """ (text, n_tokens) of all paragraphs with lo < id <= hi, in batches """
+        query = self._filter(select(ProcessedParagraph.text, ProcessedParagraph.n_tokens))
+        query = query.where(ProcessedParagraph.id > lo, ProcessedParagraph.id <= hi).order_by(ProcessedParagraph.id)
+        with self.engine.connect() as con:
+            result = con.execution_options(stream_results=True, yield_per=batch_size).execute(query)
+            for partition in result.partitions():
+                yield [(text, n_tokens) for text, n_tokens in partition]
+
+    def iter_batches(self, page_size: int = 10000,
+                     pages: Optional[List[Tuple[int, int]]] = None) -> Iterator[List[Tuple[str, int]]]:
+        """ (text, n_tokens) of all paragraphs, page by page (ordered by id).
+            `pages`: only read these pages (see `pages`, e.g., a random sample for debugging)
+        """
+        for lo, hi in (self.pages(page_size) if pages is None else pages):
+            yield from self.iter_page(lo, hi, batch_size=page_size)
+
+
+class CorpusWriter:
+    """ Buffered writer for a text corpus: one training unit per line """
+
+    def __init__(self, path: Union[str, Path], lowercase: bool = False, buffer_size: int = 2 ** 22):
+        self.path = Path(path)
+        self.lowercase = lowercase
+        self.n_lines = 0
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path, 'w', encoding='utf-8', buffering=buffer_size)
+
+    def __repr__(self) -> str:
+        return f"<CorpusWriter(path={self.path}, lowercase={self.lowercase})>"
+
+    def __enter__(self) -> 'CorpusWriter':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def write(self, texts: Iterable[str]) -> None:
+        lines = '\n'.join(texts)
+        if not lines:
+            return
+        if self.lowercase:
+            lines = lines.lower()
+        self.n_lines += lines.count('\n') + 1
+        self._file.write(lines)
+        self._file.write('\n')
+
+    def close(self) -> None:
+        if not self._file.closed:
+            self._file.close()
+
+
+MANIFEST = 'manifest.json'
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('Compressed corpus shards require the zstandard package: pip install zstandard')
+    return zstandard
+
+
+class ShardedCorpusWriter:
+    """ Write a corpus as zstd compressed shards (`part-00000.txt.zst`, ...) into a directory,
+        every shard has up to `lines_per_shard` lines. Concatenating the shards gives the corpus.
+        `manifest.json` lists the shards with their number of lines, tokens, size and md5 sum
+        (of the uncompressed text); `metadata` is added to the manifest.
+        An existing corpus in `directory` is replaced; other existing directories are refused.
+    """
+
+    def __init__(self, directory: Union[str, Path], lines_per_shard: int, lowercase: bool = False,
+                 level: int = 3, metadata: Optional[dict] = None):
+        self.directory = Path(directory)
+        self.lines_per_shard = max(lines_per_shard, 1)
+        self.lowercase = lowercase
+        self.metadata = metadata or {}
+        self.n_lines = 0
+        self.shards: List[dict] = []
+        self._compressor = _zstandard().ZstdCompressor(level=level)
+        self._file = None
+        self._shard = None
+        self._md5 = None
+        if self.directory.exists():
+            # only replace an earlier corpus, never delete other data
+            if not (self.directory / MANIFEST).exists():
+                raise FileExistsError(f'{self.directory} exists and is not a sharded corpus (no {MANIFEST})')
+            shutil.rmtree(self.directory)
+        self.directory.mkdir(parents=True)
+
+    def __repr__(self) -> str:
+        return f"<ShardedCorpusWriter(directory={self.directory}, lowercase={self.lowercase})>"
+
+    def __enter__(self) -> 'ShardedCorpusWriter':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def _open_shard(self) -> None:
+        self._shard = {'file': f'part-{len(self.shards):05d}.txt.zst', 'n_lines': 0, 'n_tokens': 0, 'size': 0}
+        self._md5 = hashlib.md5()
+        self._file = self._compressor.stream_writer(open(self.directory / self._shard['file'], 'wb'), closefd=True)
+
+    def _close_shard(self) -> None:
+        if self._file is None:
+            return
+        self._file.close()
+        self._shard['md5'] = self._md5.hexdigest()
+        self._shard['compressed_size'] = (self.directory / self._shard['file']).stat().st_size
+        self.shards.append(self._shard)
+        self._file = None
+
+    def write(self, texts: Iterable[str]) -> None:
+        texts = list(texts)
+        while texts:
+            if self._file is None:
+                self._open_shard()
+            n = self.lines_per_shard - self._shard['n_lines']
+            chunk, texts = texts[:n], texts[n:]
+            lines = '\n'.join(chunk) + '\n'
+            if self.lowercase:
+                lines = lines.lower()
+            data = lines.encode('utf-8')
+            self._file.write(data)
+            self._md5.update(data)
+            self._shard['n_lines'] += len(chunk)
+            self._shard['n_tokens'] += len(lines.split())
+            self._shard['size'] += len(data)
+            self.n_lines += len(chunk)
+            if self._shard['n_lines'] >= self.lines_per_shard:
+                self._close_shard()
+
+    def close(self) -> None:
+        self._close_shard()
+        manifest = dict(self.metadata,
+                        compression='zstd',
+                        lowercase=self.lowercase,
+                        n_lines=sum(shard['n_lines'] for shard in self.shards),
+                        n_tokens=sum(shard['n_tokens'] for shard in self.shards),
+                        size=sum(shard['size'] for shard in self.shards),
+                        shards=self.shards)
+        with open(self.directory / MANIFEST, 'w') as f:
+            json.dump(manifest, f, indent=True)
+
+
+def read_manifest(path: Union[str, Path]) -> dict:
+    """ Manifest of a sharded corpus (path of the directory or of the manifest) """
+    path = Path(path)
+    if path.is_dir():
+        path = path / MANIFEST
+    with open(path) as f:
+        return json.load(f)
+
+
+def reassemble_corpus(path: Union[str, Path], output_file: Union[str, Path], chunk_size: int = 2 ** 22) -> Path:
+    """ Decompress all shards of a sharded corpus (directory or manifest)
+        into one text file and verify their md5 sums
+    """
+    path = Path(path)
+    directory = path if path.is_dir() else path.parent
+    manifest = read_manifest(path)
+    decompressor = _zstandard().ZstdDecompressor()
+    output_file = Path(output_file)
+    with open(output_file, 'wb') as out:
+        for shard in manifest['shards']:
+            md5 = hashlib.md5()
+            with decompressor.stream_reader(open(directory / shard['file'], 'rb'), closefd=True) as reader:
+                while True:
+                    chunk = reader.read(chunk_size)
+                    if not chunk:
+                        break
+                    md5.update(chunk)
+                    out.write(chunk)
+            if md5.hexdigest() != shard['md5']:
+                raise ValueError(f"Checksum mismatch in shard {directory / shard['file']}")
+    return output_file
+
+
+class ShuffleWriter:
+    """ Shuffle all lines before writing them to another writer (e.g., `CorpusWriter`).
+        Lines are distributed to `n_buckets` temporary files in `tmp_dir`;
+        when closing, every bucket is read, shuffled and written.
+        Memory: about one bucket (number of lines / `n_buckets`).
+    """
+
+    def __init__(self, writer: CorpusWriter, n_buckets: int = 1, seed: Optional[int] = None,
+                 tmp_dir: Optional[Union[str, Path]] = None, buffer_size: int = 2 ** 20):
+        self.writer = writer
+        self.n_buckets = max(n_buckets, 1)
+        self.rng = np.random.default_rng(seed)
+        self._tmp_dir = tempfile.TemporaryDirectory(prefix='shuffle_', dir=tmp_dir)
+        # newline='': read back lines exactly as written ('\r' is no line break)
+        self._buckets = [open(Path(self._tmp_dir.name) / f'bucket_{i}.txt', 'w+', encoding='utf-8', newline='',
+                              buffering=buffer_size)
+                         for i in range(self.n_buckets)]
+
+    def __repr__(self) -> str:
+        return f"<ShuffleWriter(n_buckets={self.n_buckets}, writer={self.writer})>"
+
+    def __enter__(self) -> 'ShuffleWriter':
+        return self
+
+    def __exit__(self, exc_type, *args) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    @property
+    def n_lines(self) -> int:
+        return self.writer.n_lines
+
+    def write(self, texts: Iterable[str]) -> None:
+        """ First pass: send every line to a random bucket """
+        texts = list(texts)
+        if len(texts) == 0:
+            return
+        if self.n_buckets == 1:
+            self._buckets[0].write('\n'.join(texts) + '\n')
+            return
+        bucket_ids = self.rng.integers(self.n_buckets, size=len(texts))
+        order = np.argsort(bucket_ids, kind='stable')
+        bounds = np.searchsorted(bucket_ids[order], np.arange(self.n_buckets + 1))
+        for bucket, start, end in zip(self._buckets, bounds[:-1], bounds[1:]):
+            if start < end:
+                bucket.write('\n'.join(texts[i] for i in order[start:end]) + '\n')
+
+    def close(self) -> None:
+        """ Second pass: shuffle every bucket and write it """
+        if self._buckets is None:
+            return
+        for bucket in self._buckets:
+            bucket.seek(0)
+            lines = bucket.read().split('\n')[:-1]
+            bucket.close()
+            permutation = self.rng.permutation(len(lines))
+            self.writer.write(lines[i] for i in permutation)
+        self._buckets = None
+        self._tmp_dir.cleanup()
+        self.writer.close()
+
+    def discard(self) -> None:
+        """ Remove the buckets without writing them (e.g., after an error) """
+        if self._buckets is None:
+            return
+        for bucket in self._buckets:
+            bucket.close()
+        self._buckets = None
+        self._tmp_dir.cleanup()
+        self.writer.close()
+
+
+class ThreadedWriter:
+    """ Write (and close) another writer in a background thread.
+        `write` only puts the texts into a queue (up to `queue_size` batches wait),
+        errors of the writer are raised by the next `write` or by `close`.
+    """
+
+    def __init__(self, writer, queue_size: int = 4):
+        self.writer = writer
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._error: Optional[BaseException] = None
+        self._finished = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __repr__(self) -> str:
+        return f"<ThreadedWriter(writer={self.writer})>"
+
+    def __enter__(self) -> 'ThreadedWriter':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    @property
+    def n_lines(self) -> int:
+        return self.writer.n_lines
+
+    def _run(self) -> None:
+        while True:
+            texts = self._queue.get()
+            if texts is None:
+                break
+            if self._error is not None:
+                # keep consuming, so the producer does not block
+                continue
+            try:
+                self.writer.write(texts)
+            except BaseException as e:
+                self._error = e
+        if self._error is None:
+            try:
+                self.writer.close()
+            except BaseException as e:
+                self._error = e
+
+    def write(self, texts: Iterable[str]) -> None:
+        if self._error is not None:
+            raise self._error
+        self._queue.put(list(texts))
+
+    def finish(self) -> None:
+        """ Signal the end of the texts without waiting: the writer is closed in the background
+            (e.g., to close several writers in parallel before calling `close` on each)
+        """
+        if self._finished:
+            return
+        self._queue.put(None)
+        self._finished = True
+
+    def close(self) -> None:
+        if self._thread is None:
+            return
+        self.finish()
+        self._thread.join()
+        self._thread = None
+        if self._error is not None:
+            raise self._error
+
+
+# thresholds for the vocabulary size by minimum count (fastText -minCount)
+MIN_COUNTS = [1, 2, 3, 5, 10, 20, 50, 100, 200, 500, 1000]
+# quantiles of the line length (tokens per line)
+LENGTH_QUANTILES = [0.01, 0.05, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99]
+
+
+class StatsWriter:
+    """ Collect statistics of all lines before writing them to another writer
+        and save them as JSON file (`path`) when closing:
+        number of lines, tokens and types, distribution of line lengths (tokens per line)
+        and the vocabulary size (and share of tokens covered) by minimum count.
+        `metadata` is added to the statistics. With `total_lines` (number of lines before
+        filtering by minimum length), the share of dropped lines is calculated.
+    """
+
+    def __init__(self, writer, path: Union[str, Path], lowercase: bool = False,
+                 total_lines: Optional[int] = None, metadata: Optional[dict] = None):
+        self.writer = writer
+        self.path = Path(path)
+        self.lowercase = lowercase
+        self.total_lines = total_lines
+        self.metadata = metadata or {}
+        self.token_counts = Counter()
+        self.line_lengths = Counter()
+
+    def __repr__(self) -> str:
+        return f"<StatsWriter(path={self.path}, writer={self.writer})>"
+
+    def __enter__(self) -> 'StatsWriter':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    @property
+    def n_lines(self) -> int:
+        return self.writer.n_lines
+
+    def write(self, texts: Iterable[str]) -> None:
+        texts = list(texts)
+        lines = '\n'.join(texts)
+        if self.lowercase:
+            lines = lines.lower()
+        self.token_counts.update(lines.split())
+        self.line_lengths.update(map(len, map(str.split, texts)))
+        self.writer.write(texts)
+
+    def stats(self) -> dict:
+        n_lines = sum(self.line_lengths.values())
+        n_tokens = sum(self.token_counts.values())
+        counts = np.fromiter(self.token_counts.values(), dtype=np.int64, count=len(self.token_counts))
+        lengths = np.array(sorted(self.line_lengths.keys()), dtype=np.int64)
+        cumulative = np.cumsum([self.line_lengths[length] for length in lengths])
+        stats = dict(self.metadata,
+                     lowercase=self.lowercase,
+                     n_lines=n_lines,
+                     n_tokens=n_tokens,
+                     n_types=len(self.token_counts))
+        if self.total_lines is not None:
+            stats['n_lines_dropped'] = self.total_lines - n_lines
+            stats['share_dropped'] = (self.total_lines - n_lines) / self.total_lines if self.total_lines else 0.0
+        stats['line_length'] = {
+            'mean': n_tokens / n_lines if n_lines else 0.0,
+            'min': int(lengths[0]) if n_lines else 0,
+            'max': int(lengths[-1]) if n_lines else 0,
+            'quantiles': {str(q): int(lengths[np.searchsorted(cumulative, q * n_lines)]) if n_lines else 0
+                          for q in LENGTH_QUANTILES},
+            'histogram': {str(length): self.line_lengths[length] for length in lengths.tolist()},
+        }
+        stats['vocabulary'] = [{'min_count': min_count,
+                                'n_types': int((counts >= min_count).sum()),
+                                'share_tokens': float(counts[counts >= min_count].sum() / n_tokens) if n_tokens else 0.0}
+                               for min_count in MIN_COUNTS]
+        return stats
+
+    def close(self) -> None:
+        self.writer.close()
+        with open(self.path, 'w') as f:
+            json.dump(self.stats(), f, indent=True)
@@ -1,10 +1,49 @@
+import os
 from typing import Optional
-from sqlalchemy import ForeignKey, BigInteger, DateTime, func
+from sqlalchemy import ForeignKey, BigInteger, DateTime, UniqueConstraint, func, String, LargeBinary
+from sqlalchemy.types import TypeDecorator
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.orm import Mapped
 from sqlalchemy.orm import mapped_column
 from sqlalchemy.orm import relationship
 from datetime import datetime
+from dotenv import load_dotenv
+load_dotenv()
+
+# storage format of md5 sums: "hex" (32 character strings) or "binary" (16 byte digests)
+# convert existing databases with `python3 utils/migrate.py --hash_format binary`
+HASH_FORMAT = os.environ.get('OEMBEDDINGS_HASH_FORMAT', 'hex')
+if HASH_FORMAT not in ('hex', 'binary'):
+    raise ValueError(f'Unknown OEMBEDDINGS_HASH_FORMAT: {HASH_FORMAT} (use "hex" or "binary")')
+
+class HashDigest(TypeDecorator):
+    """ md5 sum, always a hex string in Python.
+        Stored as string or as 16 byte binary digest (`OEMBEDDINGS_HASH_FORMAT=binary`),
+        which halves the size of the column and its unique index.
+    """
+
+    impl = String
+    cache_ok = True
+
+    @property
+    def python_type(self):
+        return str
+
+    def load_dialect_impl(self, dialect):
+        if HASH_FORMAT == 'binary':
+            return dialect.type_descriptor(LargeBinary(16))
+        return dialect.type_descriptor(String())
+
+    def process_bind_param(self, value, dialect):
+        if HASH_FORMAT == 'binary' and isinstance(value, str):
+            return bytes.fromhex(value)
+        return value
+
+    def process_result_value(self, value, dialect):
+        if isinstance(value, (bytes, memoryview)):
+            return bytes(value).hex()
+        return value
+
 
 class Base(DeclarativeBase):
     
@@ -17,10 +56,12 @@ class Base(DeclarativeBase):
 
 class Article(Base):
     __tablename__ = "articles"
+    # SQLite: never reuse ids of deleted articles (cleaning watermarks rely on increasing ids)
+    __table_args__ = {'sqlite_autoincrement': True}
     id: Mapped[int] = mapped_column(primary_key=True)
     source: Mapped[str] = mapped_column(index=True)
     article_id: Mapped[int] = mapped_column(BigInteger, nullable=False, index=True) # native id of article (potentially duplicated)
-    article_md5: Mapped[str] = mapped_column(index=True, nullable=False, unique=True) # hashed URL of article (md5sum), has to be unique
+    article_md5: Mapped[str] = mapped_column(HashDigest, index=True, nullable=False, unique=True) # hashed URL of article (md5sum), has to be unique
     url: Mapped[str] = mapped_column(nullable=False, index=True)
     section: Mapped[Optional[str]]
     premium: Mapped[Optional[int]]
@@ -53,7 +94,7 @@ class RawSentence(Base):
     __tablename__ = 'raw_sentences'
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    sentence_md5: Mapped[str] = mapped_column(index=True, nullable=False, unique=True) # hash value of sentence to determine duplicates
+    sentence_md5: Mapped[str] = mapped_column(HashDigest, index=True, nullable=False, unique=True) # hash value of sentence to determine duplicates
     sentence: Mapped[str] = mapped_column(nullable=False) # actual sentence
     count: Mapped[int] = mapped_column(default=1) # count how many times the sentence was found in the dataset
 
@@ -66,7 +107,7 @@ class Sentence(Base):
     __tablename__ = 'sentences'
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    sentence_md5: Mapped[str] = mapped_column(index=True, nullable=False, unique=True) # hash value of sentence to determine duplicates
+    sentence_md5: Mapped[str] = mapped_column(HashDigest, index=True, nullable=False, unique=True) # hash value of sentence to determine duplicates
     sentence: Mapped[str] = mapped_column(nullable=False) # actual sentence
     n_tokens: Mapped[int] = mapped_column(default=0, index=True) # number of tokens
     count: Mapped[int] = mapped_column(default=1) # count how many times the sentence was found in the dataset
@@ -78,11 +119,64 @@ class ProcessedParagraph(Base):
 
     __tablename__ = 'processed_articles'
 
+    __table_args__ = (UniqueConstraint('settings', 'md5', name='uq_processed_articles_settings_md5'), )
+
     id: Mapped[int] = mapped_column(primary_key=True)
-    md5: Mapped[str] = mapped_column(index=True, nullable=False, unique=True) # hash value of article to determine duplicates
+    settings: Mapped[str] = mapped_column(index=True, nullable=False) # fingerprint of the cleaning settings (see CleaningSettings)
+    md5: Mapped[str] = mapped_column(HashDigest, index=True, nullable=False) # hash value of article to determine duplicates (unique per settings)
     text: Mapped[str] = mapped_column(nullable=False) # actual sentence
     n_tokens: Mapped[int] = mapped_column(default=0, index=True) # number of tokens
     count: Mapped[int] = mapped_column(default=1) # count how many times the article was found in the dataset
 
     def __repr__(self) -> str:
-        return (f"<ProcessedArticle(md5={self.md5})>")
\ No newline at end of file
+        return (f"<ProcessedArticle(settings={self.settings}, md5={self.md5})>")
+
+class CleaningSettings(Base):
+
+    __tablename__ = 'cleaning_settings'
+
+    fingerprint: Mapped[str] = mapped_column(primary_key=True) # CleaningPlan.fingerprint
+    settings: Mapped[str] = mapped_column(nullable=False) # settings as JSON
+    created_at: Mapped[datetime] = mapped_column(default=datetime.now)
+
+    def __repr__(self) -> str:
+        return (f"<CleaningSettings(fingerprint={self.fingerprint}, settings={self.settings})>")
+
+class CleaningWatermark(Base):
+
+    __tablename__ = 'cleaning_watermarks'
+
+    settings: Mapped[str] = mapped_column(primary_key=True) # fingerprint of the cleaning settings (see CleaningSettings)
+    scope: Mapped[str] = mapped_column(primary_key=True) # date filters of the run (e.g., "after=2019-01-01,before=2019-12-31"; empty: all articles)
+    last_id: Mapped[int] = mapped_column(BigInteger, nullable=False) # all articles with Article.id <= last_id (in the scope) are processed
+    updated_at: Mapped[datetime] = mapped_column(default=datetime.now, onupdate=datetime.now)
+
+    def __repr__(self) -> str:
+        return (f"<CleaningWatermark(settings={self.settings}, scope={self.scope}, last_id={self.last_id})>")
+
+class TokenFrequency(Base):
+
+    __tablename__ = 'token_frequencies'
+
+    settings: Mapped[str] = mapped_column(primary_key=True) # fingerprint of the cleaning settings (see CleaningSettings)
+    token: Mapped[str] = mapped_column(primary_key=True) # token (whitespace separated)
+    count: Mapped[int] = mapped_column(BigInteger, default=0) # how many times the token was found in processed paragraphs (weighted by their count)
+
+    def __repr__(self) -> str:
+        return (f"<TokenFrequency(settings={self.settings}, token={self.token}, count={self.count})>")
+
+class IngestedFile(Base):
+
+    __tablename__ = 'ingest_manifest'
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    path: Mapped[str] = mapped_column(index=True, nullable=False, unique=True) # path relative to the raw data directory
+    size: Mapped[int] = mapped_column(BigInteger, nullable=False) # file size in bytes
+    mtime: Mapped[float] = mapped_column(nullable=False) # modification time (unix timestamp)
+    checksum: Mapped[str] = mapped_column(nullable=False) # md5 sum of file content
+    rows_read: Mapped[int] = mapped_column(BigInteger, default=0) # number of rows in the file
+    rows_added: Mapped[int] = mapped_column(BigInteger, default=0) # number of new articles the file added to the database
+    loaded_at: Mapped[datetime] = mapped_column(default=datetime.now)
+
+    def __repr__(self) -> str:
+        return (f"<IngestedFile(path={self.path}, rows_added={self.rows_added})>")
@@ -0,0 +1,124 @@
+"""
+    Persistent index of md5 hashes (e.g., `Article.article_md5`) for fast
+    duplicate checks while loading data.
+
+    The index is stored next to the database as a sorted array of
+    16 byte digests (`<name>.npy`) plus an append-only log of digests
+    that were added since the last compaction (`<name>.log`).
+    Lookups are a binary search, so checking a new batch of articles
+    costs the same regardless of how many articles are already loaded.
+    The unique index in the database stays the ground truth: if the number
+    of hashes in the index does not match the number of rows in the database,
+    the index is rebuilt from the database.
+"""
+
+from pathlib import Path
+from typing import Iterable, List
+
+import numpy as np
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session, InstrumentedAttribute
+
+DIGEST = np.dtype('S16')
+
+
+def to_digests(hexdigests: Iterable[str]) -> np.ndarray:
+    """ Convert hex md5 strings to an array of 16 byte digests """
+    hexdigests = list(hexdigests)
+    if len(hexdigests) == 0:
+        return np.empty(0, dtype=DIGEST)
+    return np.frombuffer(bytes.fromhex(''.join(hexdigests)), dtype=DIGEST)
+
+
+class HashIndex:
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        # append the suffix: names can contain dots (`my.data_article_md5`)
+        self.base_path = self.path.with_name(self.path.name + '.npy')
+        self.log_path = self.path.with_name(self.path.name + '.log')
+        # sorted digests
+        self.digests = np.empty(0, dtype=DIGEST)
+        # digests added since last compaction
+        self.added = set()
+        # digests added since last flush (not yet in log file)
+        self.pending: List[np.ndarray] = []
+
+    @classmethod
+    def open(cls, path: Path, session: Session, column: InstrumentedAttribute) -> 'HashIndex':
+        """ Load the index from disk and verify it against the database.
+            Rebuilds the index if it is missing or out of sync.
+        """
+        index = cls(path)
+        index.load()
+        n_rows = session.execute(select(func.count(column))).scalar()
+        if len(index) != n_rows:
+            print(f'Hash index out of sync ({len(index)} hashes, {n_rows} rows), rebuilding from database...')
+            index.rebuild(session, column)
+        return index
+
+    def __len__(self) -> int:
+        return len(self.digests) + len(self.added)
+
+    def load(self) -> None:
+        if self.base_path.exists():
+            self.digests = np.load(self.base_path)
+        if self.log_path.exists():
+            log = np.fromfile(self.log_path, dtype=DIGEST)
+            self.added = set(log.tolist())
+
+    def rebuild(self, session: Session, column: InstrumentedAttribute, batch_size: int = 100000) -> None:
+        """ Read all hashes from the database in batches and write a fresh index """
+        chunks = []
+        result = session.execute(select(column).execution_options(yield_per=batch_size))
+        for partition in result.partitions():
+            chunks.append(to_digests(row[0] for row in partition))
+        self.digests = np.sort(np.concatenate(chunks)) if chunks else np.empty(0, dtype=DIGEST)
+        self.added = set()
+        self.pending = []
+        self.save()
+
+    def reset(self) -> None:
+        """ Remove all hashes, e.g., after the table was cleared """
+        self.digests = np.empty(0, dtype=DIGEST)
+        self.added = set()
+        self.pending = []
+        self.save()
+
+    def contains(self, hexdigests: Iterable[str]) -> np.ndarray:
+        """ Returns a boolean mask: True for every hash that is already in the index """
+        query = to_digests(hexdigests)
+        mask = np.zeros(len(query), dtype=bool)
+        if len(self.digests) > 0:
+            positions = np.searchsorted(self.digests, query)
+            positions[positions == len(self.digests)] = 0
+            mask = self.digests[positions] == query
+        if len(self.added) > 0:
+            mask |= np.fromiter((q in self.added for q in query.tolist()), dtype=bool, count=len(query))
+        return mask
+
+    def add(self, hexdigests: Iterable[str]) -> None:
+        digests = to_digests(hexdigests)
+        self.added.update(digests.tolist())
+        self.pending.append(digests)
+
+    def flush(self) -> None:
+        """ Append newly added hashes to the log file (cheap, call after every commit) """
+        if len(self.pending) == 0:
+            return
+        with open(self.log_path, 'ab') as f:
+            for digests in self.pending:
+                digests.tofile(f)
+        self.pending = []
+
+    def save(self) -> None:
+        """ Merge all added hashes into the sorted array and truncate the log """
+        if len(self.added) > 0:
+            added = np.array(sorted(self.added), dtype=DIGEST)
+            self.digests = np.sort(np.concatenate([self.digests, added]))
+            self.added = set()
+        self.pending = []
+        self.base_path.parent.mkdir(parents=True, exist_ok=True)
+        np.save(self.base_path, self.digests)
+        if self.log_path.exists():
+            self.log_path.unlink()
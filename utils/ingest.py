@@ -0,0 +1,444 @@
+"""
+    Helpers for loading raw feather files (Arrow IPC format) into the SQL database.
+    Files are memory-mapped and processed in fixed-size record batches, so
+    the memory footprint does not depend on the size of the feather file.
+    Compressed files (`.xz`, `.zst`, `.gz`) are decompressed on the fly.
+"""
+
+import io
+import re
+import gzip
+import lzma
+import hashlib
+import threading
+import queue
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+# run pandas apply in parallel:
+import swifter
+swifter.set_defaults(allow_dask_on_strings=True)
+# ftfy: fix text for you (solves encoding issues)
+import ftfy
+from sqlalchemy import select, insert, update
+from sqlalchemy.engine import Connection
+
+from utils.misc import md5sum_batch
+from utils.cleaning import WRONG_ENCODING
+from utils.datamodel import IngestedFile
+from utils.profiling import StageTimer, optional_stage
+
+# columns that might contain text with encoding issues
+TEXT_COLUMNS = {"headline", "description", "pretitle", "lead_paragraph", "body"}
+
+# there is currently a parsing bug for diepresse that caused some
+# sentences not to be separated properly
+# we can fix that with a crude regex
+WRONG_SENTENCES = re.compile(r"(\b[A-ZÄÖÜa-zäöü]{3,}?!?)([A-Z])")
+
+
+# safe wrapper
+def fix_text(text: Any) -> Union[str, None]:
+    try:
+        return ftfy.fix_text(text)
+    except:
+        return None
+
+
+# compressed raw data files are read as streams
+COMPRESSED_SUFFIXES = {'.xz', '.zst', '.gz'}
+
+# first bytes of an Arrow IPC file (feather v2)
+ARROW_MAGIC = b'ARROW1'
+# first bytes of a feather v1 file (old raw dumps, not an Arrow IPC file)
+FEATHER_V1_MAGIC = b'FEA1'
+
+
+def is_compressed(path: Path) -> bool:
+    return path.suffix in COMPRESSED_SUFFIXES
+
+
+def open_decompressed(path: Path) -> io.RawIOBase:
+    """ Open a compressed file for reading, returns a binary file object """
+    if path.suffix == '.xz':
+        return lzma.open(path, 'rb')
+    if path.suffix == '.gz':
+        return gzip.open(path, 'rb')
+    if path.suffix == '.zst':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('Reading .zst files requires the zstandard package: pip install zstandard')
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    raise ValueError(f'Unknown compression: {path}')
+
+
+def prefetch(iterable: Iterable, depth: int = 1) -> Iterator:
+    """ Consume an iterable in a background thread and keep up to `depth`
+        items ready. Used to read the next batch while the previous
+        one is being written to the database.
+    """
+    buffer = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item) -> bool:
+        # give up when the consumer went away
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def producer():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as e:
+            put(e)
+        put(done)
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is done:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+class BackgroundReader(io.RawIOBase):
+    """ Read a file object in a background thread (in chunks).
+        Decompression releases the GIL, so it overlaps with parsing
+        the data in the calling thread.
+    """
+
+    def __init__(self, fileobj: io.RawIOBase, chunk_size: int = 1 << 22, depth: int = 4):
+        self._fileobj = fileobj
+        self._chunks = prefetch(iter(lambda: fileobj.read(chunk_size), b''), depth=depth)
+        self._buffer = memoryview(b'')
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while len(self._buffer) == 0:
+            try:
+                self._buffer = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+    def close(self) -> None:
+        if not self.closed:
+            self._chunks.close()
+            self._fileobj.close()
+        super().close()
+
+
+def open_ipc(source: pa.NativeFile) -> Union[pa.ipc.RecordBatchFileReader, pa.ipc.RecordBatchStreamReader]:
+    """ Open an Arrow IPC source, either in file format (feather v2) or stream format """
+    try:
+        return pa.ipc.open_file(source)
+    except pa.ArrowInvalid:
+        source.seek(0)
+        return pa.ipc.open_stream(source)
+
+
+def open_ipc_stream(stream: io.BufferedReader) -> pa.ipc.RecordBatchStreamReader:
+    """ Open a non-seekable Arrow IPC source.
+        The file format is the stream format between a magic
+        header (8 bytes) and a footer, so we skip the header and
+        read the batches sequentially.
+    """
+    if stream.peek(len(ARROW_MAGIC))[:len(ARROW_MAGIC)] == ARROW_MAGIC:
+        stream.read(8)
+    return pa.ipc.open_stream(stream)
+
+
+def read_feather_v1(source: Union[pa.NativeFile, io.BufferedReader]) -> pa.Table:
+    """ Feather v1 files have no record batches: read the whole table """
+    if isinstance(source, io.BufferedReader):
+        # not seekable (decompressed on the fly)
+        source = pa.BufferReader(source.read())
+    return feather.read_table(source)
+
+
+def iter_record_batches(path: Path, batch_size: int = 50000) -> Iterator[pa.RecordBatch]:
+    """ Memory-map an Arrow IPC file and yield record batches
+        with at most `batch_size` rows. Slicing is zero-copy,
+        so only the batch that is currently converted is held in memory.
+        Compressed files are decompressed in a background thread instead.
+        Feather v1 files are read as a whole.
+    """
+    if is_compressed(path):
+        with io.BufferedReader(BackgroundReader(open_decompressed(path)), buffer_size=1 << 20) as stream:
+            if stream.peek(len(FEATHER_V1_MAGIC))[:len(FEATHER_V1_MAGIC)] == FEATHER_V1_MAGIC:
+                batches = read_feather_v1(stream).to_batches()
+            else:
+                batches = open_ipc_stream(stream)
+            for batch in batches:
+                for offset in range(0, batch.num_rows, batch_size):
+                    yield batch.slice(offset, batch_size)
+        return
+    with pa.memory_map(str(path), 'r') as source:
+        if source.read(len(FEATHER_V1_MAGIC)) == FEATHER_V1_MAGIC:
+            source.seek(0)
+            for batch in read_feather_v1(source).to_batches():
+                for offset in range(0, batch.num_rows, batch_size):
+                    yield batch.slice(offset, batch_size)
+            return
+        source.seek(0)
+        reader = open_ipc(source)
+        if isinstance(reader, pa.ipc.RecordBatchFileReader):
+            batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+        else:
+            batches = reader
+        for batch in batches:
+            for offset in range(0, batch.num_rows, batch_size):
+                yield batch.slice(offset, batch_size)
+
+
+def read_feather(path: Path) -> pd.DataFrame:
+    """ Read a whole (optionally compressed) feather file """
+    if is_compressed(path):
+        with io.BufferedReader(BackgroundReader(open_decompressed(path)), buffer_size=1 << 20) as stream:
+            if stream.peek(len(FEATHER_V1_MAGIC))[:len(FEATHER_V1_MAGIC)] == FEATHER_V1_MAGIC:
+                return read_feather_v1(stream).to_pandas()
+            return open_ipc_stream(stream).read_pandas()
+    with pa.memory_map(str(path), 'r') as source:
+        if source.read(len(FEATHER_V1_MAGIC)) == FEATHER_V1_MAGIC:
+            source.seek(0)
+            return read_feather_v1(source).to_pandas()
+        source.seek(0)
+        return open_ipc(source).read_pandas()
+
+
+def iter_feather_batches(path: Path, batch_size: int = 50000) -> Iterator[pd.DataFrame]:
+    """ Yield a feather file as pandas DataFrames with at most `batch_size` rows """
+    for batch in iter_record_batches(path, batch_size=batch_size):
+        yield batch.to_pandas()
+
+
+# articles per file loaded with --debug
+DEBUG_SAMPLE_SIZE = 100
+
+
+def sample_batches(batches: Iterable[pd.DataFrame], n: int = DEBUG_SAMPLE_SIZE) -> pd.DataFrame:
+    """ Random sample of `n` rows of all batches (e.g., of a whole file).
+        Every row gets a random key, the rows with the `n` smallest keys are kept,
+        so only the sample and the current batch are held in memory.
+    """
+    rng = np.random.default_rng()
+    sample = None
+    for df in batches:
+        df = df.assign(_sample_key=rng.random(len(df)))
+        sample = df if sample is None else pd.concat([sample, df], ignore_index=True)
+        sample = sample.nsmallest(n, '_sample_key')
+    if sample is None:
+        return pd.DataFrame()
+    return sample.drop(columns='_sample_key').reset_index(drop=True)
+
+
+def apply(series: pd.Series, func: Callable, parallel: bool = True) -> pd.Series:
+    """ Apply a function to every element of a series,
+        with swifter (parallel) or plain pandas
+    """
+    if parallel:
+        return series.swifter.apply(func)
+    return series.apply(func)
+
+
+def fix_encoding(df: pd.DataFrame, text_cols: Iterable[str], parallel: bool = True,
+                 timer: Optional[StageTimer] = None, source_name: str = '') -> Dict[str, int]:
+    """ Scan every text column once for indicators of a wrong encoding
+        and repair only the affected rows (in place).
+        Returns the number of repaired rows per column.
+    """
+    repaired = {}
+    for col in sorted(text_cols):
+        try:
+            with optional_stage(timer, source_name, 'encoding scan'):
+                mask = df[col].str.contains(WRONG_ENCODING, na=False).to_numpy(dtype=bool)
+        except AttributeError:
+            # not a text column
+            continue
+        repaired[col] = int(mask.sum())
+        if repaired[col] > 0:
+            print(f'Fixing encoding in column {col}: {repaired[col]} of {len(df)} rows')
+            with optional_stage(timer, source_name, 'ftfy', rows=repaired[col]):
+                df.loc[mask, col] = apply(df.loc[mask, col], fix_text, parallel)
+    if timer is not None:
+        timer.add(source_name, 'encoding scan', rows=len(df))
+    return repaired
+
+
+def prepare_articles(df: pd.DataFrame, source_name: str, parallel: bool = True,
+                     timer: Optional[StageTimer] = None) -> pd.DataFrame:
+    """ Prepare raw articles for loading into the database:
+        hash URLs, drop duplicates, fix encoding issues and
+        apply outlet specific fixes.
+        `source_name` is the name of the feather file the articles come from.
+        Set `parallel=False` when already running in a worker process.
+        Pass a `timer` to measure the time of each step.
+    """
+    print('Calculating md5 sum for URL column')
+    with optional_stage(timer, source_name, 'hash', rows=len(df)):
+        df['article_md5'] = md5sum_batch(df.url, threads=None if parallel else 1)
+        df.drop_duplicates(subset="article_md5", inplace=True, ignore_index=True)
+
+    # some texts might have the wrong encoding
+    text_cols = set(df.columns.tolist()).intersection(TEXT_COLUMNS)
+    fix_encoding(df, text_cols, parallel, timer=timer, source_name=source_name)
+
+    if 'diepresse' in source_name:
+        with optional_stage(timer, source_name, 'regex fixes', rows=len(df)):
+            df['body'] = apply(df['body'], lambda x: WRONG_SENTENCES.sub(r"\1. \2", x), parallel)
+
+    return df
+
+
+""" Parallel ingest: worker processes prepare whole feather files
+    and hand the finished batches to a single writer via a queue
+"""
+
+_batches: multiprocessing.Queue = None
+
+
+def _init_worker(batches: multiprocessing.Queue) -> None:
+    global _batches
+    _batches = batches
+
+
+def prepare_file(path: Path, batch_size: int = 50000, debug: bool = False) -> Path:
+    """ Worker function: read a feather file in batches, prepare the articles
+        and put them on the queue as `(path, DataFrame, rows read, timings)`.
+        Signals the end of the file with `(path, None, 0, timings)`.
+    """
+    timer = StageTimer()
+    try:
+        batches = timer.iterate(iter_feather_batches(path, batch_size=batch_size), path.name, 'read')
+        if debug:
+            batches = [sample_batches(batches)]
+        for df in batches:
+            n_rows = len(df)
+            df = prepare_articles(df, path.name, parallel=False, timer=timer)
+            _batches.put((path, df, n_rows, timer.export(clear=True)))
+    finally:
+        timer.add(path.name, 'read', bytes=path.stat().st_size)
+        _batches.put((path, None, 0, timer.export()))
+    return path
+
+
+def _check_workers(futures: List[Future]) -> None:
+    """ Raise the exception of a failed worker. If a worker process died
+        (a killed worker never sends the end of its file), all tasks fail with `BrokenProcessPool`
+    """
+    for future in futures:
+        if future.done():
+            future.result()
+
+
+def prepare_files_parallel(paths: List[Path], workers: int, batch_size: int = 50000,
+                           debug: bool = False, queue_size: int = 4,
+                           poll_interval: float = 5.0) -> Iterator[Tuple[Path, pd.DataFrame, int, dict]]:
+    """ Prepare feather files in `workers` processes (one file per worker at a time)
+        and yield the prepared batches as `(path, DataFrame, rows read, timings)` in the calling process.
+        When a file is completed, `(path, None, 0, timings)` is yielded.
+        The timings can be merged into a `StageTimer`.
+        `queue_size` limits how many prepared batches wait for the writer.
+        While waiting for batches, the workers are checked every `poll_interval` seconds.
+    """
+    batches = multiprocessing.Queue(maxsize=queue_size)
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(batches, )) as executor:
+        futures = [executor.submit(prepare_file, path, batch_size, debug) for path in paths]
+        finished = 0
+        all_done = False
+        while finished < len(paths):
+            try:
+                path, df, n_rows, timings = batches.get(timeout=poll_interval)
+            except queue.Empty:
+                _check_workers(futures)
+                # all tasks returned one interval ago, but files are missing
+                if all_done:
+                    raise RuntimeError(f'Workers finished, but only {finished} of {len(paths)} files were completed')
+                all_done = all(future.done() for future in futures)
+                continue
+            if df is None:
+                finished += 1
+            yield path, df, n_rows, timings
+        # raise exceptions of workers
+        for future in futures:
+            future.result()
+
+
+""" Ingest manifest: keep track of files that were loaded completely,
+    so that unchanged files are skipped when the loader runs again
+"""
+
+def file_checksum(path: Path, chunk_size: int = 1 << 20) -> str:
+    """ md5 sum of the file content """
+    file_md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            file_md5.update(chunk)
+    return file_md5.hexdigest()
+
+
+def is_unchanged(connection: Connection, path: Path, root: Path) -> bool:
+    """ Check whether the file was loaded completely before and has not changed since.
+        Size and modification time are compared first,
+        the content checksum is only calculated when the modification time changed.
+    """
+    table = IngestedFile.__table__
+    entry = connection.execute(select(table).where(table.c.path == path.relative_to(root).as_posix())).first()
+    if entry is None:
+        return False
+    stat = path.stat()
+    if entry.size != stat.st_size:
+        return False
+    if entry.mtime == stat.st_mtime:
+        return True
+    if entry.checksum != file_checksum(path):
+        return False
+    # same content, only touched
+    connection.execute(update(table).where(table.c.id == entry.id).values(mtime=stat.st_mtime))
+    return True
+
+
+def record_file(connection: Connection, path: Path, root: Path, rows_read: int, rows_added: int) -> None:
+    """ Add (or update) the manifest entry of a completely loaded file """
+    table = IngestedFile.__table__
+    relative_path = path.relative_to(root).as_posix()
+    stat = path.stat()
+    values = dict(size=stat.st_size,
+                  mtime=stat.st_mtime,
+                  checksum=file_checksum(path),
+                  rows_read=rows_read,
+                  loaded_at=datetime.now())
+    entry = connection.execute(select(table).where(table.c.path == relative_path)).first()
+    if entry is None:
+        connection.execute(insert(table).values(path=relative_path, rows_added=rows_added, **values))
+    else:
+        # changed file: rows added by previous versions stay in the database
+        connection.execute(update(table).where(table.c.id == entry.id)
+                           .values(rows_added=entry.rows_added + rows_added, **values))
@@ -0,0 +1,105 @@
+"""
+    Update the schema of an existing database to the current data model.
+    New tables are created automatically by `start_sqlsession`,
+    this script handles changes to existing tables.
+
+    `python3 utils/migrate.py`
+
+    - `processed_articles`: add the `settings` column (fingerprint of the cleaning settings);
+      `md5` is unique per settings instead of globally. Existing rows get the fingerprint
+      given with `--legacy_settings` (default: "legacy"), because the settings
+      they were cleaned with are not known.
+    - md5 columns (`articles.article_md5`, `processed_articles.md5`, `raw_sentences.sentence_md5`,
+      `sentences.sentence_md5`): convert between hex strings and 16 byte binary digests
+      with `--hash_format binary` (or back with `--hash_format hex`). Set `OEMBEDDINGS_HASH_FORMAT`
+      in your `.env` accordingly afterwards.
+"""
+
+import sys
+sys.path.append('.')
+import json
+from argparse import ArgumentParser
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Engine
+
+from utils.sql import start_sqlsession
+from utils.datamodel import Base, CleaningSettings, HashDigest, HASH_FORMAT
+
+
+def migrate_processed_paragraphs(engine: Engine, legacy_settings: str = 'legacy') -> bool:
+    """ Add the settings fingerprint to `processed_articles`. Returns False if nothing had to be done """
+    columns = [col['name'] for col in inspect(engine).get_columns('processed_articles')]
+    if 'settings' in columns:
+        return False
+    print(f'Adding column "settings" to processed_articles (existing rows: "{legacy_settings}")')
+    with engine.begin() as con:
+        con.execute(text("ALTER TABLE processed_articles ADD COLUMN settings VARCHAR"))
+        con.execute(text("UPDATE processed_articles SET settings = :settings"), {'settings': legacy_settings})
+        if engine.dialect.name == 'postgresql':
+            con.execute(text("ALTER TABLE processed_articles ALTER COLUMN settings SET NOT NULL"))
+        con.execute(text("DROP INDEX IF EXISTS ix_processed_articles_md5"))
+        con.execute(text("CREATE INDEX ix_processed_articles_md5 ON processed_articles (md5)"))
+        con.execute(text("CREATE INDEX ix_processed_articles_settings ON processed_articles (settings)"))
+        con.execute(text("CREATE UNIQUE INDEX uq_processed_articles_settings_md5 ON processed_articles (settings, md5)"))
+        con.execute(CleaningSettings.__table__.insert().values(fingerprint=legacy_settings,
+                                                              settings=json.dumps({'unknown': True})))
+    return True
+
+
+def migrate_hash_columns(engine: Engine, hash_format: str) -> bool:
+    """ Convert all md5 columns to hex strings or binary digests. Returns False if nothing had to be done """
+    inspector = inspect(engine)
+    changed = False
+    for table in Base.metadata.sorted_tables:
+        if table.name not in inspector.get_table_names():
+            continue
+        for column in table.columns:
+            if not isinstance(column.type, HashDigest):
+                continue
+            with engine.begin() as con:
+                if engine.dialect.name == 'postgresql':
+                    current_type = {col['name']: col['type'] for col in inspector.get_columns(table.name)}[column.name]
+                    is_binary = current_type.python_type is bytes
+                    if is_binary == (hash_format == 'binary'):
+                        continue
+                    print(f'Converting {table.name}.{column.name} to {hash_format}')
+                    if hash_format == 'binary':
+                        con.execute(text(f"ALTER TABLE {table.name} ALTER COLUMN {column.name} TYPE bytea USING decode({column.name}, 'hex')"))
+                    else:
+                        con.execute(text(f"ALTER TABLE {table.name} ALTER COLUMN {column.name} TYPE VARCHAR USING encode({column.name}, 'hex')"))
+                elif engine.dialect.name == 'sqlite':
+                    # SQLite does not enforce column types: convert the values in place
+                    if hash_format == 'binary':
+                        con.connection.driver_connection.create_function('unhex_md5', 1, lambda value: bytes.fromhex(value), deterministic=True)
+                        result = con.execute(text(f"UPDATE {table.name} SET {column.name} = unhex_md5({column.name}) WHERE typeof({column.name}) = 'text'"))
+                    else:
+                        result = con.execute(text(f"UPDATE {table.name} SET {column.name} = lower(hex({column.name})) WHERE typeof({column.name}) = 'blob'"))
+                    if result.rowcount == 0:
+                        continue
+                    print(f'Converted {result.rowcount} rows of {table.name}.{column.name} to {hash_format}')
+                else:
+                    raise NotImplementedError(f'Converting hash columns is not supported for {engine.dialect.name}')
+            changed = True
+    if changed and engine.dialect.name == 'sqlite':
+        print('Run "VACUUM" on the database to reclaim the freed space')
+    return changed
+
+
+if __name__ == '__main__':
+    arg_parser = ArgumentParser(description="Update the schema of an existing database")
+    arg_parser.add_argument('--legacy_settings', type=str, default='legacy',
+                            help='Settings fingerprint for existing processed paragraphs (default: "legacy")')
+    arg_parser.add_argument('--hash_format', type=str, choices=['hex', 'binary'], default=None,
+                            help='Convert md5 columns to hex strings or 16 byte binary digests')
+    input_args = arg_parser.parse_args()
+
+    session, engine = start_sqlsession()
+
+    changed = migrate_processed_paragraphs(engine, legacy_settings=input_args.legacy_settings)
+    if input_args.hash_format:
+        changed = migrate_hash_columns(engine, input_args.hash_format) or changed
+        if input_args.hash_format != HASH_FORMAT:
+            print(f'Set OEMBEDDINGS_HASH_FORMAT={input_args.hash_format} in your .env')
+    print('Database updated' if changed else 'Database is up to date')
+    session.close()
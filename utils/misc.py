@@ -1,14 +1,45 @@
 import hashlib
-from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Any, List, Optional
 import os
 
+import numpy as np
+
 # Helper function to calc md5 sum (unique fingerprint of text)
-@lru_cache(maxsize=None)
 def md5sum(text: str) -> str:
     text_md5 = hashlib.md5(text.encode('utf-8'))
     return text_md5.hexdigest()
 
+def _md5sum_chunk(texts: List[Optional[str]]) -> List[Optional[str]]:
+    return [hashlib.md5(text.encode('utf-8')).hexdigest() if text is not None else None for text in texts]
+
+def md5sum_batch(texts: Any, threads: Optional[int] = None, chunk_size: int = 20000) -> np.ndarray:
+    """ 
+        Calculate md5 sums for a batch of texts at once.
+        Accepts a list, numpy array, pandas Series or Arrow array of strings
+        and returns an array of hex digests (None for missing values).
+        Chunks are hashed in a thread pool: hashlib releases the GIL
+        while hashing longer texts (> 2 KiB, e.g., paragraphs).
+    """
+    if hasattr(texts, 'to_pylist'):
+        # arrow array
+        texts = texts.to_pylist()
+    elif hasattr(texts, 'tolist'):
+        # pandas series, numpy array
+        texts = texts.tolist()
+    else:
+        texts = list(texts)
+    digests = np.empty(len(texts), dtype=object)
+    if len(texts) <= chunk_size:
+        digests[:] = _md5sum_chunk(texts)
+        return digests
+    chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+    with ThreadPoolExecutor(threads or os.cpu_count()) as executor:
+        for i, chunk_digests in enumerate(executor.map(_md5sum_chunk, chunks)):
+            digests[i * chunk_size:i * chunk_size + len(chunk_digests)] = chunk_digests
+    return digests
+
 def harmonic_mean(x: float, y: float) -> float:
     return ((2 * x * y) / (x + y))
 
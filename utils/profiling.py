@@ -0,0 +1,123 @@
+"""
+    Lightweight instrumentation for long running pipeline stages:
+    collects wall-clock time, rows and bytes per (file, stage),
+    reports throughput (rows/sec, bytes/sec) and peak memory usage.
+"""
+
+import json
+import resource
+import sys
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, Optional
+
+import pandas as pd
+
+
+def peak_rss_mb(children: bool = False) -> float:
+    """ Peak resident set size in MB of this process (or of the largest child process) """
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # linux reports kilobytes, macOS bytes
+    factor = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return usage.ru_maxrss / factor
+
+
+class StageTimer:
+
+    def __init__(self):
+        # (file, stage) -> measurements
+        self.records: Dict[tuple, Dict[str, float]] = defaultdict(lambda: {'seconds': 0.0, 'rows': 0, 'bytes': 0})
+        self.started = datetime.now()
+
+    def add(self, file: str, stage: str, seconds: float = 0.0, rows: int = 0, bytes: int = 0) -> None:
+        record = self.records[(str(file), stage)]
+        record['seconds'] += seconds
+        record['rows'] += rows
+        record['bytes'] += bytes
+
+    @contextmanager
+    def stage(self, file: str, stage: str, rows: int = 0, bytes: int = 0) -> Iterator[None]:
+        """ Time a block of code: `with timer.stage(file, 'hash', rows=len(df)): ...` """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(file, stage, time.perf_counter() - start, rows, bytes)
+
+    def iterate(self, iterable: Iterable, file: str, stage: str) -> Iterator:
+        """ Time how long it takes to get each item of an iterable (e.g., reading batches) """
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(file, stage, time.perf_counter() - start)
+                return
+            self.add(file, stage, time.perf_counter() - start, rows=len(item))
+            yield item
+
+    def export(self, clear: bool = False) -> Dict[tuple, Dict[str, float]]:
+        """ Plain dictionary, e.g., to send measurements from a worker process.
+            Use `clear=True` to start over (only send new measurements next time).
+        """
+        records = dict(self.records)
+        if clear:
+            self.records.clear()
+        return records
+
+    def merge(self, records: Dict[tuple, Dict[str, float]]) -> None:
+        for (file, stage), record in records.items():
+            self.add(file, stage, **record)
+
+    def to_frame(self) -> pd.DataFrame:
+        df = pd.DataFrame([{'file': file, 'stage': stage, **record}
+                           for (file, stage), record in self.records.items()],
+                          columns=['file', 'stage', 'seconds', 'rows', 'bytes'])
+        seconds = df.seconds.where(df.seconds > 0)
+        df['rows_per_sec'] = df.rows / seconds
+        df['bytes_per_sec'] = df.bytes.where(df.bytes > 0) / seconds
+        return df
+
+    def summary(self, input_stage: str = 'read') -> str:
+        """ Table with one row per stage (summed over all files) and one row per file.
+            Rows and bytes of a file are taken from the `input_stage`.
+        """
+        df = self.to_frame()
+        if len(df) == 0:
+            return 'No measurements'
+        stages = df.groupby('stage', sort=False)[['seconds', 'rows', 'bytes']].sum()
+        files = df.groupby('file', sort=False)[['seconds']].sum()
+        files = files.join(df[df.stage == input_stage].set_index('file')[['rows', 'bytes']])
+        for table in (stages, files):
+            seconds = table.seconds.where(table.seconds > 0)
+            table['rows_per_sec'] = table.rows / seconds
+            table['MB_per_sec'] = table.bytes.where(table.bytes > 0) / seconds / 1e6
+        return '\n'.join(['Stages (all files):', stages.round(2).to_string(),
+                          '', 'Files (time summed over stages):', files.round(2).to_string(),
+                          '', f'Peak RSS: {peak_rss_mb():.1f} MB (largest worker: {peak_rss_mb(children=True):.1f} MB)'])
+
+    def write_json(self, path: Path, **meta: Any) -> None:
+        """ Machine-readable report, `meta` is added on the top level (e.g., settings of the run) """
+        df = self.to_frame()
+        report = dict(started=self.started,
+                      finished=datetime.now(),
+                      peak_rss_mb=peak_rss_mb(),
+                      peak_rss_mb_workers=peak_rss_mb(children=True),
+                      **meta,
+                      stages=df.astype(object).where(df.notna(), None).to_dict('records'))
+        with open(path, 'w') as f:
+            json.dump(report, f, default=str, indent=True)
+
+
+@contextmanager
+def optional_stage(timer: Optional[StageTimer], file: str, stage: str, rows: int = 0, bytes: int = 0) -> Iterator[None]:
+    """ Like `StageTimer.stage`, but does nothing when no timer is given """
+    if timer is None:
+        yield
+    else:
+        with timer.stage(file, stage, rows=rows, bytes=bytes):
+            yield
@@ -1,8 +1,16 @@
 
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine, inspect
+from sqlalchemy import create_engine, inspect, select, func, Table, Integer
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine import Connection
+from sqlalchemy.dialects import postgresql, sqlite
+from typing import Dict, Iterator, List, Optional, Union
 import os
-from utils.datamodel import Base, Article
+import io
+from pathlib import Path
+import pandas as pd
+from utils.datamodel import Base, Article, HashDigest, HASH_FORMAT
+from utils.misc import get_data_dir
 from dotenv import load_dotenv
 load_dotenv()
 import os
@@ -26,3 +34,129 @@ def start_sqlsession(connect_string=dbstring, echo=False, **kwargs):
             Base.metadata.create_all(engine)
 
     return session, engine
+
+
+def get_sidecar_path(engine, name: str) -> Path:
+    """ Path for files that belong to the database (indices, reports).
+        For SQLite they are stored next to the database file,
+        otherwise in the data directory.
+        The file name is prefixed with the name of the database.
+    """
+    database = engine.url.database
+    if engine.dialect.name == 'sqlite' and database and database != ':memory:':
+        db_path = Path(database).absolute()
+        return db_path.parent / f"{db_path.stem}_{name}"
+    return get_data_dir() / f"{database or engine.dialect.name}_{name}"
+
+
+def bulk_insert(connection: Connection, table: Table, df: pd.DataFrame) -> None:
+    """ Insert all rows of a DataFrame into a table within the current transaction.
+        PostgreSQL: uses `COPY ... FROM STDIN` (fastest way to load data)
+        Other databases: uses a single `executemany`
+    """
+    if len(df) == 0:
+        return
+    if connection.dialect.name == 'postgresql':
+        # COPY bypasses the type conversion of SQLAlchemy: prepare the values as text
+        df = df.copy()
+        for col in table.columns:
+            if col.name not in df.columns:
+                continue
+            if isinstance(col.type, Integer):
+                # nullable integer columns arrive as float64 ("1.0")
+                df[col.name] = df[col.name].astype('Int64')
+            elif isinstance(col.type, HashDigest) and HASH_FORMAT == 'binary':
+                # bytea in text format
+                df[col.name] = '\\x' + df[col.name]
+        buffer = io.StringIO()
+        df.to_csv(buffer, index=False, header=False, na_rep='\\N')
+        buffer.seek(0)
+        columns = ', '.join(f'"{col}"' for col in df.columns)
+        cursor = connection.connection.cursor()
+        cursor.copy_expert(f"COPY {table.name} ({columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buffer)
+        cursor.close()
+    else:
+        records = df.astype(object).where(df.notna(), None).to_dict('records')
+        connection.execute(table.insert(), records)
+
+
+def upsert_counts(connection: Connection, table: Table, records: List[Dict],
+                  keys: Union[str, List[str]] = 'md5', count_column: str = 'count', batch_size: int = 10000) -> None:
+    """ Insert rows or, if a row with the same `keys` exists already,
+        add the count of the new row to the existing one:
+        `INSERT ... ON CONFLICT (keys) DO UPDATE SET count = count + excluded.count`
+        The keys need a unique constraint. Supported for PostgreSQL and SQLite (>= 3.24).
+        `records` must not contain duplicate keys.
+    """
+    if len(records) == 0:
+        return
+    dialect = {'postgresql': postgresql, 'sqlite': sqlite}.get(connection.dialect.name)
+    if dialect is None:
+        raise NotImplementedError(f'Upsert not supported for database <{connection.dialect.name}>')
+    statement = dialect.insert(table)
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c[key] for key in ([keys] if isinstance(keys, str) else keys)],
+        set_={count_column: table.c[count_column] + statement.excluded[count_column]})
+    for i in range(0, len(records), batch_size):
+        connection.execute(statement, records[i:i + batch_size])
+
+
+class SQLArticleReader:
+    """ Stream articles from the SQL database.
+        Same interface as `utils.articlestore.ParquetArticleStore`:
+        only the requested columns are selected, and articles are read
+        in batches ordered by `id` (keyset pagination: `WHERE id > last_id LIMIT n`).
+    """
+
+    def __init__(self, engine: Engine):
+        self.engine = engine
+
+    def __repr__(self) -> str:
+        return f"<SQLArticleReader(url={self.engine.url!r})>"
+
+    @staticmethod
+    def _filter(query, before: Optional[str] = None, after: Optional[str] = None, since_id: Optional[int] = None):
+        if since_id:
+            query = query.where(Article.id > since_id)
+        # compare with timestamps: SQLite compares strings ('2019-01-05 10:00' > '2019-01-05')
+        if before:
+            query = query.where(Article.date_published < pd.Timestamp(before).normalize() + pd.Timedelta(days=1))
+        if after:
+            query = query.where(Article.date_published >= pd.Timestamp(after).normalize())
+        return query
+
+    def max_id(self) -> int:
+        """ Highest article id (0 if empty) """
+        with self.engine.connect() as con:
+            return con.execute(select(func.max(Article.id))).scalar() or 0
+
+    def count(self, before: Optional[str] = None, after: Optional[str] = None, since_id: Optional[int] = None) -> int:
+        query = self._filter(select(func.count(Article.id)), before, after, since_id)
+        with self.engine.connect() as con:
+            return con.execute(query).scalar()
+
+    def iter_batches(self, columns: List[str],
+                     before: Optional[str] = None,
+                     after: Optional[str] = None,
+                     batch_size: int = 10000,
+                     since_id: Optional[int] = None,
+                     ids: Optional[List[int]] = None) -> Iterator[pd.DataFrame]:
+        """ Stream articles as DataFrames with the `id` and the requested columns.
+            `since_id`: only articles with a higher id (e.g., added since the last run)
+            `ids`: only these articles (e.g., a random sample)
+        """
+        columns = ['id'] + [col for col in columns if col != 'id']
+        query = self._filter(select(*[getattr(Article, col) for col in columns]), before, after)
+        if ids is not None:
+            query = query.where(Article.id.in_(ids))
+        query = query.order_by(Article.id).limit(batch_size)
+        last_id = since_id or None
+        while True:
+            with self.engine.connect() as con:
+                batch = pd.read_sql(query if last_id is None else query.where(Article.id > last_id), con)
+            if len(batch) == 0:
+                break
+            yield batch
+            if len(batch) < batch_size:
+                break
+            last_id = int(batch.id.iloc[-1])